@@ -201,6 +201,10 @@ async def startup_event():
     # 在后台启动任务处理器
     asyncio.create_task(start_task_processor())
     print("后台任务处理器已启动")
+    
+    from services.terminal_service import get_terminal_manager
+    # 启动终端会话的定期清理
+    get_terminal_manager().start()
     print("WebSocket服务已启动")
     print("✅ 后端服务启动完成！")
 
@@ -210,6 +214,9 @@ async def shutdown_event():
     from services.task_processor import stop_task_processor
     stop_task_processor()
     print("后台任务处理器已停止")
+    
+    from services.terminal_service import get_terminal_manager
+    get_terminal_manager().shutdown()
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8080, reload=True)
\ No newline at end of file
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+数据库迁移脚本：为常用查询添加索引
+- task_logs(task_id, created_at)：按任务查询日志并按时间排序
+- tasks(status)：按状态筛选和统计任务
+"""
+
+from database import get_db
+from sqlalchemy import text
+
+INDEXES = [
+    ('ix_task_logs_task_created', 'CREATE INDEX ix_task_logs_task_created ON task_logs (task_id, created_at)'),
+    ('ix_tasks_status', 'CREATE INDEX ix_tasks_status ON tasks (status)'),
+]
+
+def migrate_query_indexes():
+    """添加查询索引"""
+    db = next(get_db())
+
+    try:
+        for name, ddl in INDEXES:
+            try:
+                db.execute(text(ddl))
+                print(f'✅ 添加索引{name}成功')
+            except Exception as e:
+                print(f'⚠️ 索引{name}可能已存在: {e}')
+
+        db.commit()
+        print('🎉 数据库迁移完成')
+
+    except Exception as e:
+        db.rollback()
+        print(f'❌ 迁移失败: {e}')
+        raise
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    migrate_query_indexes()
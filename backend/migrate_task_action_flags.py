@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+数据库迁移脚本：为tasks表添加工作流操作完成标记字段
+并根据task_logs中的action_tag回填已完成的操作
+"""
+
+from database import get_db
+from sqlalchemy import text
+
+# 操作 -> tasks表中对应的完成标记字段
+ACTION_FLAGS = {
+    'generate_code': 'generate_code_completed',
+    'submit_code': 'submit_code_completed',
+    'admin_review': 'admin_review_completed',
+    'deploy': 'deploy_completed'
+}
+
+def migrate_task_action_flags():
+    """迁移tasks表，添加操作完成标记字段"""
+    db = next(get_db())
+
+    try:
+        for action, flag in ACTION_FLAGS.items():
+            # 添加标记字段
+            try:
+                db.execute(text(f'ALTER TABLE tasks ADD COLUMN {flag} BOOLEAN NOT NULL DEFAULT FALSE'))
+                print(f'✅ 添加{flag}字段成功')
+            except Exception as e:
+                print(f'⚠️ {flag}字段可能已存在: {e}')
+
+            # 根据已有的操作完成日志回填
+            result = db.execute(text(
+                f"UPDATE tasks SET {flag} = TRUE "
+                f"WHERE EXISTS (SELECT 1 FROM task_logs "
+                f"WHERE task_logs.task_id = tasks.id AND task_logs.action_tag = :action_tag)"
+            ), {'action_tag': f'{action}:completed'})
+            print(f'✅ 回填了 {result.rowcount} 个任务的{flag}')
+
+        db.commit()
+        print('🎉 数据库迁移完成')
+
+    except Exception as e:
+        db.rollback()
+        print(f'❌ 迁移失败: {e}')
+        raise
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    migrate_task_action_flags()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+数据库迁移脚本：为task_logs表添加action_tag字段及(task_id, action_tag)索引
+并从旧日志消息中的 "action:xxx:completed" 标记回填action_tag
+"""
+
+import re
+from database import get_db
+from sqlalchemy import text
+
+ACTION_MARKER_RE = re.compile(r'action:([^:\s]+):completed')
+
+def migrate_task_log_action_tag():
+    """迁移task_logs表，添加action_tag字段和索引"""
+    db = next(get_db())
+    
+    try:
+        # 添加action_tag字段
+        try:
+            db.execute(text('ALTER TABLE task_logs ADD COLUMN action_tag VARCHAR(64) NULL'))
+            print('✅ 添加action_tag字段成功')
+        except Exception as e:
+            print(f'⚠️ action_tag字段可能已存在: {e}')
+        
+        # 添加复合索引
+        try:
+            db.execute(text('CREATE INDEX ix_task_logs_task_action_tag ON task_logs (task_id, action_tag)'))
+            print('✅ 添加(task_id, action_tag)索引成功')
+        except Exception as e:
+            print(f'⚠️ 索引可能已存在: {e}')
+        
+        # 回填旧记录的action_tag
+        rows = db.execute(text(
+            "SELECT id, message FROM task_logs "
+            "WHERE action_tag IS NULL AND message LIKE '%action:%:completed%'"
+        )).all()
+        
+        updates = []
+        for log_id, message in rows:
+            match = ACTION_MARKER_RE.search(message or '')
+            if match:
+                updates.append({'id': log_id, 'action_tag': f'{match.group(1)}:completed'})
+        
+        if updates:
+            db.execute(text('UPDATE task_logs SET action_tag = :action_tag WHERE id = :id'), updates)
+        print(f'✅ 回填了 {len(updates)} 条记录的action_tag')
+        
+        db.commit()
+        print('🎉 数据库迁移完成')
+        
+    except Exception as e:
+        db.rollback()
+        print(f'❌ 迁移失败: {e}')
+        raise
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    migrate_task_log_action_tag()
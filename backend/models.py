@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, JSON, Enum
+from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, JSON, Enum, Index, false
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -58,7 +58,7 @@ class Task(Base):
     description = Column(Text)
     input_params = Column(JSON)  # 输入参数定义
     output_params = Column(JSON)  # 输出参数定义
-    status = Column(Enum(TaskStatus), default=TaskStatus.SUBMITTED)
+    status = Column(Enum(TaskStatus), default=TaskStatus.SUBMITTED, index=True)
     priority = Column(Enum(TaskPriority), default=TaskPriority.MEDIUM)  # 任务优先级
     branch_name = Column(String(100))  # Git分支名
     git_branch = Column(String(100))  # Git功能分支名
@@ -70,6 +70,10 @@ class Task(Base):
     test_status = Column(String(50))  # 测试状态: pending, running, passed, failed
     test_results = Column(Text)  # 测试结果详情（JSON格式）
     admin_comment = Column(Text)  # 管理员审核意见
+    generate_code_completed = Column(Boolean, nullable=False, default=False, server_default=false())  # 已完成代码生成操作
+    submit_code_completed = Column(Boolean, nullable=False, default=False, server_default=false())  # 已完成代码提交操作
+    admin_review_completed = Column(Boolean, nullable=False, default=False, server_default=false())  # 已完成管理员审核操作
+    deploy_completed = Column(Boolean, nullable=False, default=False, server_default=false())  # 已完成部署操作
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     
@@ -103,11 +107,17 @@ class TaskLog(Base):
     action_type = Column(String(50), nullable=False)  # 操作类型：create_task, generate_code, submit_code, review, deploy等
     status = Column(String(50), nullable=False)
     message = Column(Text)
+    action_tag = Column(String(64), nullable=True)  # 操作标记，如 generate_code:completed，用于等值查询
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # 关系
     task = relationship("Task", back_populates="logs")
     user = relationship("User")  # 操作用户
+    
+    __table_args__ = (
+        Index('ix_task_logs_task_action_tag', 'task_id', 'action_tag'),
+        Index('ix_task_logs_task_created', 'task_id', 'created_at'),  # 按任务查询日志并按时间排序
+    )
 
 class DeploymentConnectionStatus(str, enum.Enum):
     DISCONNECTED = "disconnected"
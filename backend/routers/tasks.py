@@ -295,6 +295,9 @@ async def mark_action_completed(
     if current_user.role.value != 'admin' and task.user_id != current_user.id:
         raise HTTPException(status_code=403, detail="无权操作此任务")
     
+    if not TaskWorkflowService.is_markable_action(action):
+        raise HTTPException(status_code=400, detail=f"未知的操作：{action}")
+    
     workflow_service = TaskWorkflowService(db)
     success = workflow_service.mark_action_completed(task, action, message, current_user)
     
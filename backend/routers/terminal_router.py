@@ -135,10 +135,10 @@ async def websocket_terminal(websocket: WebSocket, session_id: str, token: str =
         
         # 如果会话未启动，启动它
         if not session.is_active:
-            session.start(lambda data: asyncio.create_task(output_callback(data)))
+            await session.start(output_callback)
         else:
             # 更新输出回调
-            session.output_callback = lambda data: asyncio.create_task(output_callback(data))
+            session.output_callback = output_callback
         
         # 发送连接成功消息
         await websocket.send_text(json.dumps({
@@ -158,7 +158,7 @@ async def websocket_terminal(websocket: WebSocket, session_id: str, token: str =
                 if message_type == "input":
                     # 处理用户输入
                     input_data = message.get("data", "")
-                    session.write(input_data)
+                    await session.write(input_data)
                 
                 elif message_type == "resize":
                     # 处理终端大小调整
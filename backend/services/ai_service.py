@@ -1,3 +1,4 @@
+import asyncio
 import requests
 import json
 import os
@@ -572,7 +573,9 @@ class AICodeGenerationService:
                 "presence_penalty": 0
             }
             
-            response = requests.post(
+            # requests是同步库，放到线程中执行以免阻塞事件循环，使多个任务的AI调用可以并发
+            response = await asyncio.to_thread(
+                requests.post,
                 f"{self.base_url}/chat/completions",
                 headers=headers,
                 json=data,
@@ -2,6 +2,10 @@ import re
 import os
 import json
 import logging
+import threading
+import time
+from collections import OrderedDict
+from operator import attrgetter
 from typing import List, Dict, Optional, Tuple
 from sqlalchemy.orm import Session
 from models import Task, DeploymentSession, DeploymentStep, DeploymentStepStatus, DeploymentConnectionStatus
@@ -9,6 +13,49 @@ from services.ssh_manager import ssh_manager
 
 logger = logging.getLogger(__name__)
 
+# get_steps_status返回的步骤字段，用attrgetter一次取出
+_STEP_STATUS_FIELDS = (
+    "step_number", "step_name", "step_description", "status", "completed_at",
+    "created_at", "error_message", "command", "expected_output", "actual_output"
+)
+_get_step_status_fields = attrgetter(*_STEP_STATUS_FIELDS)
+
+class _SessionIdCache:
+    """(task_id, user_id) -> DeploymentSession.id 的小型TTL缓存，供步骤状态轮询使用"""
+    
+    def __init__(self, maxsize: int = 256, ttl: float = 1.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: Tuple[int, int]) -> Optional[int]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            session_id, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return session_id
+    
+    def set(self, key: Tuple[int, int], session_id: int):
+        with self._lock:
+            self._data[key] = (session_id, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def invalidate(self, task_id: int):
+        """清除某个任务的所有缓存项"""
+        with self._lock:
+            for key in [key for key in self._data if key[0] == task_id]:
+                del self._data[key]
+
+_session_id_cache = _SessionIdCache()
+
 class GuidedDeploymentService:
     """引导式部署服务"""
     
@@ -521,6 +568,7 @@ class GuidedDeploymentService:
             db.add(session)
             db.commit()
             db.refresh(session)
+            _session_id_cache.invalidate(task_id)
             
             logger.info(f"部署会话创建成功: {session.id}")
             return True, session, ""
@@ -904,6 +952,7 @@ class GuidedDeploymentService:
             step.completed_at = db.execute("SELECT NOW()").scalar()
             
             db.commit()
+            _session_id_cache.invalidate(task_id)
             logger.info(f"步骤 {step_number} 已标记为完成")
             return True, "步骤已标记为完成"
             
@@ -920,35 +969,30 @@ class GuidedDeploymentService:
     ) -> Tuple[bool, List[Dict], str]:
         """获取任务的所有部署步骤状态"""
         try:
-            # 查找对应的部署会话
-            session = db.query(DeploymentSession).filter(
-                DeploymentSession.task_id == task_id,
-                DeploymentSession.user_id == user_id
-            ).first()
-            
-            if not session:
-                return False, [], "未找到对应的部署会话"
+            # 查找对应的部署会话（会话ID短时缓存，步骤状态变化频繁不缓存）
+            session_id = _session_id_cache.get((task_id, user_id))
+            if session_id is None:
+                session_id = db.query(DeploymentSession.id).filter(
+                    DeploymentSession.task_id == task_id,
+                    DeploymentSession.user_id == user_id
+                ).limit(1).scalar()
+                
+                if session_id is None:
+                    return False, [], "未找到对应的部署会话"
+                _session_id_cache.set((task_id, user_id), session_id)
             
             # 查找所有步骤
             steps = db.query(DeploymentStep).filter(
-                DeploymentStep.session_id == session.id
+                DeploymentStep.session_id == session_id
             ).order_by(DeploymentStep.step_number).all()
             
             # 构造步骤状态列表
-            steps_status = []
-            for step in steps:
-                steps_status.append({
-                    "step_number": step.step_number,
-                    "step_name": step.step_name,
-                    "step_description": step.step_description,
-                    "status": step.status.value if step.status else "pending",
-                    "completed_at": step.completed_at.isoformat() if step.completed_at else None,
-                    "created_at": step.created_at.isoformat() if step.created_at else None,
-                    "error_message": step.error_message,
-                    "command": step.command,
-                    "expected_output": step.expected_output,
-                    "actual_output": step.actual_output
-                })
+            steps_status = [dict(zip(_STEP_STATUS_FIELDS, _get_step_status_fields(step))) for step in steps]
+            for item in steps_status:
+                item["status"] = item["status"].value if item["status"] else "pending"
+                for key in ("completed_at", "created_at"):
+                    if item[key]:
+                        item[key] = item[key].isoformat()
             
             logger.info(f"获取到 {len(steps_status)} 个步骤状态")
             return True, steps_status, ""
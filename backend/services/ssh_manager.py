@@ -1,14 +1,30 @@
 import asyncio
+import errno
 import paramiko
 import io
 import logging
-from typing import Dict, Optional, Tuple, List
+import select
+import socket
+import time
+from typing import Dict, Optional, Tuple, List, Union
 from datetime import datetime, timedelta
 from concurrent.futures import ThreadPoolExecutor
 import threading
 
 logger = logging.getLogger(__name__)
 
+# 单次从channel读取的最大字节数
+_RECV_BUFFER_SIZE = 65536
+
+# SSH keepalive间隔（秒）
+_KEEPALIVE_INTERVAL = 30
+
+# 连接测试通过后的信任时长（秒），期间重复创建同一连接时跳过测试命令
+_VERIFIED_TTL = 300
+
+class _ChannelOpenError(paramiko.SSHException):
+    """命令通道尚未打开时连接已失效（命令未发送到服务器，可以安全重试）"""
+
 class SSHManager:
     """SSH连接管理器"""
     
@@ -16,7 +32,17 @@ class SSHManager:
         self.connections: Dict[str, Dict] = {}
         self.connection_timeout = 3600  # 1小时超时
         self.executor = ThreadPoolExecutor(max_workers=10)
-        self._lock = threading.Lock()
+        # 按连接ID分锁，不同连接的创建/关闭互不阻塞；_meta_lock只保护锁表本身。
+        # 锁在连接关闭后保留：其他线程可能仍持有或等待同一把锁，删除后再次获取会得到另一把锁而失去互斥。
+        # 连接ID由user@host:port决定，锁表规模以不同目标服务器数为上限
+        self._locks: Dict[str, threading.Lock] = {}
+        self._meta_lock = threading.Lock()
+        self._verified_at: Dict[str, float] = {}  # 连接ID -> 最近一次连接测试通过的时间
+    
+    def _lock_for(self, connection_id: str) -> threading.Lock:
+        """获取指定连接ID的锁"""
+        with self._meta_lock:
+            return self._locks.setdefault(connection_id, threading.Lock())
     
     def _generate_connection_id(self, host: str, port: int, username: str) -> str:
         """生成连接ID"""
@@ -40,10 +66,6 @@ class SSHManager:
         connection_id = self._generate_connection_id(host, port, username)
         
         try:
-            # 创建SSH客户端
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            
             # 连接参数
             connect_kwargs = {
                 'hostname': host,
@@ -72,26 +94,34 @@ class SSHManager:
                 return False, "", "请提供密码或SSH密钥"
             
             # 建立连接
-            ssh_client.connect(**connect_kwargs)
+            ssh_client = self._open_client(connect_kwargs)
             
-            # 测试连接
-            stdin, stdout, stderr = ssh_client.exec_command('echo "Connection test"')
-            output = stdout.read().decode().strip()
-            error = stderr.read().decode().strip()
-            
-            if error:
-                ssh_client.close()
-                return False, "", f"连接测试失败: {error}"
+            # 测试连接（近期已验证过的连接跳过）；测试命令在锁外执行，验证时间在锁内读写
+            conn_lock = self._lock_for(connection_id)
+            with conn_lock:
+                verified_at = self._verified_at.get(connection_id)
+            if verified_at is None or time.monotonic() - verified_at > _VERIFIED_TTL:
+                stdin, stdout, stderr = ssh_client.exec_command('echo "Connection test"')
+                output = stdout.read().decode().strip()
+                error = stderr.read().decode().strip()
+                
+                if error:
+                    ssh_client.close()
+                    return False, "", f"连接测试失败: {error}"
+                verified_at = time.monotonic()
             
             # 存储连接信息
-            self.connections[connection_id] = {
-                'client': ssh_client,
-                'host': host,
-                'port': port,
-                'username': username,
-                'created_at': datetime.now(),
-                'last_used': datetime.now()
-            }
+            with conn_lock:
+                self._verified_at[connection_id] = verified_at
+                self.connections[connection_id] = {
+                    'client': ssh_client,
+                    'host': host,
+                    'port': port,
+                    'username': username,
+                    'connect_kwargs': connect_kwargs,  # 断线重连时复用
+                    'created_at': datetime.now(),
+                    'last_used': time.monotonic()  # 单调时钟，仅用于过期判断
+                }
             
             logger.info(f"SSH连接创建成功: {connection_id}")
             return True, connection_id, None
@@ -103,6 +133,46 @@ class SSHManager:
         except Exception as e:
             return False, "", f"连接失败: {str(e)}"
     
+    def _auth_probe(self, connect_kwargs: Dict) -> paramiko.Transport:
+        """直接在Transport上完成握手和认证，省去SSHClient.connect的额外开销"""
+        sock = socket.create_connection(
+            (connect_kwargs['hostname'], connect_kwargs['port']),
+            timeout=connect_kwargs['timeout']
+        )
+        transport = paramiko.Transport(sock)
+        try:
+            transport.banner_timeout = connect_kwargs['banner_timeout']
+            transport.start_client(timeout=connect_kwargs['timeout'])
+            if 'pkey' in connect_kwargs:
+                transport.auth_publickey(connect_kwargs['username'], connect_kwargs['pkey'])
+            else:
+                transport.auth_password(connect_kwargs['username'], connect_kwargs['password'])
+        except Exception:
+            transport.close()
+            raise
+        return transport
+    
+    def _upgrade_to_client(self, transport: paramiko.Transport) -> paramiko.SSHClient:
+        """将已认证的Transport包装为SSHClient，供exec_command/open_sftp使用"""
+        ssh_client = paramiko.SSHClient()
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh_client._transport = transport
+        return ssh_client
+    
+    def _open_client(self, connect_kwargs: Dict) -> paramiko.SSHClient:
+        """建立已认证的SSH客户端并开启keepalive"""
+        if 'key_filename' in connect_kwargs:
+            # 密钥文件类型未知，交给SSHClient.connect处理
+            ssh_client = paramiko.SSHClient()
+            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh_client.connect(**connect_kwargs)
+        else:
+            ssh_client = self._upgrade_to_client(self._auth_probe(connect_kwargs))
+        
+        # 开启keepalive，及时发现半开连接
+        ssh_client.get_transport().set_keepalive(_KEEPALIVE_INTERVAL)
+        return ssh_client
+    
     async def execute_command(
         self, 
         connection_id: str, 
@@ -115,25 +185,32 @@ class SSHManager:
         Returns:
             Tuple[success, stdout, stderr]
         """
-        if connection_id not in self.connections:
+        connection = self.connections.get(connection_id)
+        if connection is None:
             return False, "", "连接不存在"
         
         try:
-            connection = self.connections[connection_id]
             ssh_client = connection['client']
             
             # 更新最后使用时间
-            connection['last_used'] = datetime.now()
-            
-            # 执行命令
-            stdin, stdout, stderr = ssh_client.exec_command(command, timeout=timeout)
+            connection['last_used'] = time.monotonic()
             
-            # 读取输出
-            stdout_content = stdout.read().decode('utf-8', errors='ignore')
-            stderr_content = stderr.read().decode('utf-8', errors='ignore')
-            
-            # 获取退出码
-            exit_status = stdout.channel.recv_exit_status()
+            # 在线程池中执行命令，避免阻塞事件循环
+            loop = asyncio.get_running_loop()
+            try:
+                exit_status, stdout_content, stderr_content = await loop.run_in_executor(
+                    self.executor, self._run_command_sync, ssh_client, command, timeout
+                )
+            except _ChannelOpenError as e:
+                # 通道打开前连接已失效，命令尚未执行，使用缓存的连接参数重连后重试一次；
+                # 命令发出后的失败直接返回给调用方，避免非幂等命令（git push、部署脚本等）被执行两次
+                logger.warning(f"SSH连接已断开，尝试重连 [{connection_id}]: {str(e)}")
+                await loop.run_in_executor(
+                    self.executor, self._reconnect_sync, connection_id, connection, ssh_client
+                )
+                exit_status, stdout_content, stderr_content = await loop.run_in_executor(
+                    self.executor, self._run_command_sync, connection['client'], command, timeout
+                )
             
             logger.info(f"命令执行完成 [{connection_id}]: {command} (退出码: {exit_status})")
             
@@ -143,44 +220,145 @@ class SSHManager:
             logger.error(f"命令执行失败 [{connection_id}]: {str(e)}")
             return False, "", f"命令执行失败: {str(e)}"
     
+    def _run_command_sync(
+        self,
+        ssh_client: paramiko.SSHClient,
+        command: str,
+        timeout: int
+    ) -> Tuple[int, str, str]:
+        """
+        通过原始channel执行命令，使用select等待数据，交替读取stdout/stderr，
+        避免顺序read()在大输出时互相阻塞
+        
+        Returns:
+            Tuple[exit_status, stdout, stderr]
+        """
+        transport = ssh_client.get_transport()
+        if transport is None or not transport.is_active():
+            raise _ChannelOpenError("SSH连接已断开")
+        
+        try:
+            channel = transport.open_session()
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            raise _ChannelOpenError(f"打开SSH通道失败: {str(e)}") from e
+        try:
+            channel.set_combine_stderr(False)
+            channel.exec_command(command)
+            
+            stdout_buf = bytearray()
+            stderr_buf = bytearray()
+            # timeout为无输出超时：每收到一次数据就顺延截止时间，持续输出的长命令不会被中断
+            deadline = time.monotonic() + timeout
+            
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"命令执行超时（{timeout}秒无输出）")
+                
+                select.select([channel], [], [], min(remaining, 1.0))
+                
+                received = False
+                while channel.recv_ready():
+                    stdout_buf += channel.recv(_RECV_BUFFER_SIZE)
+                    received = True
+                while channel.recv_stderr_ready():
+                    stderr_buf += channel.recv_stderr(_RECV_BUFFER_SIZE)
+                    received = True
+                if received:
+                    deadline = time.monotonic() + timeout
+                
+                if (channel.exit_status_ready()
+                        and not channel.recv_ready()
+                        and not channel.recv_stderr_ready()):
+                    break
+            
+            # 读取退出码前收尾，确保缓冲区中的剩余数据被取出
+            exit_status = channel.recv_exit_status()
+            while channel.recv_ready():
+                stdout_buf += channel.recv(_RECV_BUFFER_SIZE)
+            while channel.recv_stderr_ready():
+                stderr_buf += channel.recv_stderr(_RECV_BUFFER_SIZE)
+            
+            return (
+                exit_status,
+                stdout_buf.decode('utf-8', errors='ignore'),
+                stderr_buf.decode('utf-8', errors='ignore')
+            )
+        finally:
+            channel.close()
+    
+    def _reconnect_sync(
+        self,
+        connection_id: str,
+        connection: Dict,
+        failed_client: paramiko.SSHClient
+    ) -> paramiko.SSHClient:
+        """
+        使用缓存的连接参数重建SSH客户端，并替换连接表中的旧客户端。
+        检查、关闭和替换都在该连接的锁内完成：连接已被关闭/清理时不再重连，避免泄漏新客户端；
+        其他线程已完成重连时直接复用其客户端
+        """
+        with self._lock_for(connection_id):
+            if self.connections.get(connection_id) is not connection:
+                raise paramiko.SSHException("连接已关闭")
+            
+            if connection['client'] is not failed_client:
+                return connection['client']
+            
+            try:
+                failed_client.close()
+            except Exception:
+                pass
+            
+            connection['client'] = self._open_client(connection['connect_kwargs'])
+            return connection['client']
+    
     async def upload_file(
         self, 
         connection_id: str, 
-        file_content: str, 
+        file_content: Union[str, bytes], 
         remote_path: str
     ) -> Tuple[bool, str]:
         """
-        上传文件
+        上传文件（str内容按UTF-8编码一次后以流方式写入）
         
         Returns:
             Tuple[success, error_message]
         """
-        if connection_id not in self.connections:
+        connection = self.connections.get(connection_id)
+        if connection is None:
             return False, "连接不存在"
         
         try:
-            connection = self.connections[connection_id]
             ssh_client = connection['client']
             
             # 更新最后使用时间
-            connection['last_used'] = datetime.now()
+            connection['last_used'] = time.monotonic()
             
             # 创建SFTP客户端
             sftp = ssh_client.open_sftp()
             
-            # 确保目录存在
-            remote_dir = '/'.join(remote_path.split('/')[:-1])
-            if remote_dir:
+            try:
+                # 确保目录存在
+                remote_dir = '/'.join(remote_path.split('/')[:-1])
+                if remote_dir:
+                    self._ensure_remote_dir(sftp, remote_dir, connection)
+                
+                if isinstance(file_content, str):
+                    file_content = file_content.encode('utf-8')
+                
+                # 流式写入，confirm=False省去上传后的一次stat往返
                 try:
-                    sftp.makedirs(remote_dir)
-                except Exception:
-                    pass  # 目录可能已存在
-            
-            # 写入文件
-            with sftp.file(remote_path, 'w') as remote_file:
-                remote_file.write(file_content)
-            
-            sftp.close()
+                    sftp.putfo(io.BytesIO(file_content), remote_path, confirm=False)
+                except IOError as e:
+                    if e.errno != errno.ENOENT or not remote_dir:
+                        raise
+                    # 缓存的目录已在远端被删除（如rm -rf），清空缓存后重建目录再重试一次
+                    connection['known_dirs'] = set()
+                    self._ensure_remote_dir(sftp, remote_dir, connection)
+                    sftp.putfo(io.BytesIO(file_content), remote_path, confirm=False)
+            finally:
+                sftp.close()
             logger.info(f"文件上传成功 [{connection_id}]: {remote_path}")
             return True, ""
             
@@ -188,6 +366,24 @@ class SSHManager:
             logger.error(f"文件上传失败 [{connection_id}]: {str(e)}")
             return False, f"文件上传失败: {str(e)}"
     
+    def _ensure_remote_dir(self, sftp: paramiko.SFTPClient, remote_dir: str, connection: Dict):
+        """逐级创建远程目录，已确认存在的目录缓存在连接信息中，避免重复stat"""
+        known_dirs = connection.setdefault('known_dirs', set())
+        if remote_dir in known_dirs:
+            return
+        
+        prefix = '/' if remote_dir.startswith('/') else ''
+        parts = [part for part in remote_dir.split('/') if part]
+        for depth in range(1, len(parts) + 1):
+            current = prefix + '/'.join(parts[:depth])
+            if current in known_dirs:
+                continue
+            try:
+                sftp.stat(current)
+            except IOError:
+                sftp.mkdir(current)
+            known_dirs.add(current)
+    
     async def download_file(
         self, 
         connection_id: str, 
@@ -199,15 +395,15 @@ class SSHManager:
         Returns:
             Tuple[success, file_content, error_message]
         """
-        if connection_id not in self.connections:
+        connection = self.connections.get(connection_id)
+        if connection is None:
             return False, "", "连接不存在"
         
         try:
-            connection = self.connections[connection_id]
             ssh_client = connection['client']
             
             # 更新最后使用时间
-            connection['last_used'] = datetime.now()
+            connection['last_used'] = time.monotonic()
             
             # 创建SFTP客户端
             sftp = ssh_client.open_sftp()
@@ -226,11 +422,11 @@ class SSHManager:
     
     def check_connection(self, connection_id: str) -> bool:
         """检查连接是否有效"""
-        if connection_id not in self.connections:
+        connection = self.connections.get(connection_id)
+        if connection is None:
             return False
         
         try:
-            connection = self.connections[connection_id]
             ssh_client = connection['client']
             
             # 简单的连接测试
@@ -242,15 +438,16 @@ class SSHManager:
     
     def close_connection(self, connection_id: str) -> bool:
         """关闭连接"""
-        if connection_id not in self.connections:
+        with self._lock_for(connection_id):
+            connection = self.connections.pop(connection_id, None)
+            self._verified_at.pop(connection_id, None)
+        if connection is None:
             return False
         
         try:
-            connection = self.connections[connection_id]
             ssh_client = connection['client']
             ssh_client.close()
             
-            del self.connections[connection_id]
             logger.info(f"SSH连接已关闭: {connection_id}")
             return True
             
@@ -260,38 +457,48 @@ class SSHManager:
     
     def cleanup_expired_connections(self):
         """清理过期的连接"""
-        now = datetime.now()
-        expired_connections = []
+        now = time.monotonic()
         
-        for connection_id, connection in self.connections.items():
-            if (now - connection['last_used']).total_seconds() > self.connection_timeout:
-                expired_connections.append(connection_id)
+        # 对连接表做快照后无锁扫描，候选连接在各自的锁内复核后再关闭
+        candidates = [
+            connection_id
+            for connection_id, connection in list(self.connections.items())
+            if now - connection['last_used'] > self.connection_timeout
+        ]
         
-        for connection_id in expired_connections:
-            self.close_connection(connection_id)
+        expired_connections = []
+        for connection_id in candidates:
+            with self._lock_for(connection_id):
+                connection = self.connections.get(connection_id)
+                if connection is None or now - connection['last_used'] <= self.connection_timeout:
+                    continue
+            if self.close_connection(connection_id):
+                expired_connections.append(connection_id)
         
         if expired_connections:
             logger.info(f"清理了 {len(expired_connections)} 个过期连接")
     
     def get_connection_info(self, connection_id: str) -> Optional[Dict]:
         """获取连接信息"""
-        if connection_id not in self.connections:
+        connection = self.connections.get(connection_id)
+        if connection is None:
             return None
         
-        connection = self.connections[connection_id]
         return {
             'connection_id': connection_id,
             'host': connection['host'],
             'port': connection['port'],
             'username': connection['username'],
             'created_at': connection['created_at'],
-            'last_used': connection['last_used'],
+            # 将单调时钟换算为墙上时间用于展示
+            'last_used': datetime.now() - timedelta(seconds=time.monotonic() - connection['last_used']),
             'is_active': self.check_connection(connection_id)
         }
     
     def list_connections(self) -> List[Dict]:
         """列出所有连接"""
-        return [self.get_connection_info(conn_id) for conn_id in self.connections.keys()]
+        infos = (self.get_connection_info(conn_id) for conn_id in list(self.connections))
+        return [info for info in infos if info is not None]
 
 # 创建全局SSH管理器实例
 ssh_manager = SSHManager()
@@ -1,5 +1,6 @@
 import asyncio
 import logging
+from sqlalchemy import Row, bindparam, select
 from sqlalchemy.orm import Session
 from database import get_db, SessionLocal
 from models import Task, TaskStatus, TaskLog, Notification, NotificationType
@@ -10,12 +11,45 @@ from typing import List
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 轮询查询每5秒执行一次且结构固定，预先构建Core语句，只取调度所需的列，避免ORM对象装载
+# 正在处理中的任务在查询中排除，并发数由TaskProcessor的信号量限制
+_PENDING_TASKS_STMT = (
+    select(Task.id, Task.title, Task.status, Task.user_id, Task.branch_name)
+    .where(
+        Task.status.in_(bindparam("statuses", expanding=True)),
+        Task.id.not_in(bindparam("processing", expanding=True))
+    )
+    .order_by(Task.created_at)
+    .limit(5)  # 每次轮询最多取出的任务数
+)
+
+# 注释掉自动处理SUBMITTED状态的任务，改为手动聊天生成代码
+_PENDING_STATUSES = [
+    # TaskStatus.SUBMITTED,  # 不再自动处理已提交的任务
+    TaskStatus.AI_GENERATING
+]
+
+# main.send_realtime_notification的缓存引用，首次使用时再导入以避免循环导入
+_send_realtime = None
+
+def _get_send_realtime():
+    """获取实时通知发送函数（惰性绑定）"""
+    global _send_realtime
+    if _send_realtime is None:
+        from main import send_realtime_notification
+        _send_realtime = send_realtime_notification
+    return _send_realtime
+
 class TaskProcessor:
     """任务处理器 - 负责处理任务队列中的任务"""
     
-    def __init__(self):
+    def __init__(self, max_concurrent_ai: int = 5):
         self.is_running = False
         self.processing_tasks = set()  # 正在处理的任务ID集合
+        self._running = set()  # 处理中的asyncio.Task，保留引用防止被回收
+        self._ai_semaphore = asyncio.Semaphore(max_concurrent_ai)  # 限制同时进行的AI调用数
+        self._notify_queue: asyncio.Queue = asyncio.Queue()  # 待推送的实时通知
+        self._notifier_task = None
     
     async def start_processing(self):
         """启动任务处理循环"""
@@ -26,6 +60,10 @@ class TaskProcessor:
         self.is_running = True
         logger.info("任务处理器启动")
         
+        # 由单个协程串行消费通知队列
+        if self._notifier_task is None or self._notifier_task.done():
+            self._notifier_task = asyncio.create_task(self._notifier_loop())
+        
         while self.is_running:
             try:
                 await self._process_pending_tasks()
@@ -37,6 +75,9 @@ class TaskProcessor:
     def stop_processing(self):
         """停止任务处理"""
         self.is_running = False
+        if self._notifier_task is not None:
+            self._notifier_task.cancel()
+            self._notifier_task = None
         logger.info("任务处理器停止")
     
     async def _process_pending_tasks(self):
@@ -45,33 +86,37 @@ class TaskProcessor:
         try:
             # 查找需要处理的任务
             pending_tasks = self._get_pending_tasks(db)
-            
-            for task in pending_tasks:
-                if task.id not in self.processing_tasks:
-                    # 异步处理任务
-                    asyncio.create_task(self._process_single_task(task.id))
-                    
         except Exception as e:
             logger.error(f"获取待处理任务失败：{str(e)}")
+            return
         finally:
             db.close()
+        
+        # 逐个派发为后台任务，不等待完成，轮询循环不会被慢的AI调用拖住；AI调用并发数由信号量限制
+        for task in pending_tasks:
+            if task.id in self.processing_tasks:
+                continue
+            # 派发前登记，下一轮轮询即可跳过
+            self.processing_tasks.add(task.id)
+            running = asyncio.create_task(self._process_single_task(task.id))
+            self._running.add(running)
+            running.add_done_callback(self._on_task_done)
     
-    def _get_pending_tasks(self, db: Session) -> List[Task]:
-        """获取待处理的任务列表"""
-        # 注释掉自动处理SUBMITTED状态的任务，改为手动聊天生成代码
-        return db.query(Task).filter(
-            Task.status.in_([
-                # TaskStatus.SUBMITTED,  # 不再自动处理已提交的任务
-                TaskStatus.AI_GENERATING
-            ])
-        ).order_by(Task.created_at).limit(5).all()  # 限制并发处理数量
+    def _on_task_done(self, running: asyncio.Task):
+        """后台任务结束回调"""
+        self._running.discard(running)
+        if not running.cancelled() and running.exception() is not None:
+            logger.error(f"任务处理协程异常：{str(running.exception())}")
+    
+    def _get_pending_tasks(self, db: Session) -> List[Row]:
+        """获取待处理的任务列表（轻量行，完整的Task在_process_single_task中按需加载）"""
+        return db.execute(
+            _PENDING_TASKS_STMT,
+            {"statuses": _PENDING_STATUSES, "processing": list(self.processing_tasks)}
+        ).all()
     
     async def _process_single_task(self, task_id: int):
-        """处理单个任务"""
-        if task_id in self.processing_tasks:
-            return
-        
-        self.processing_tasks.add(task_id)
+        """处理单个任务（调用方已将task_id登记到processing_tasks）"""
         db = SessionLocal()
         
         try:
@@ -109,7 +154,7 @@ class TaskProcessor:
         # 直接进入AI代码生成阶段
         task.status = TaskStatus.AI_GENERATING
         self._add_task_log(task.id, TaskStatus.AI_GENERATING, "开始AI代码生成", db)
-        db.commit()
+        db.flush()
         
         # 模拟AI生成延时
         await asyncio.sleep(2)
@@ -123,7 +168,7 @@ class TaskProcessor:
             f"创建分支：{task.branch_name}", 
             db
         )
-        db.commit()
+        db.flush()
         
         # 发送通知
         self._create_notification(
@@ -134,12 +179,14 @@ class TaskProcessor:
             NotificationType.INFO,
             db
         )
+        # 整个状态流转只提交一次，中间步骤仅flush
         db.commit()
     
     async def _handle_ai_generating_task(self, task: Task, db: Session):
         """处理AI代码生成任务"""
         # 调用AI服务生成代码
-        success, generated_code, test_cases, error = await ai_service.generate_code(task, db)
+        async with self._ai_semaphore:
+            success, generated_code, test_cases, error = await ai_service.generate_code(task, db)
         
         if success:
             logger.info(f"任务 {task.id} AI代码生成成功")
@@ -183,11 +230,11 @@ class TaskProcessor:
         )
         db.add(task_log)
         
-        # 获取任务信息以发送实时更新
-        task = db.query(Task).filter(Task.id == task_id).first()
+        # 获取任务信息以发送实时更新（调用方已加载该任务，优先命中会话identity map）
+        task = db.get(Task, task_id)
         if task:
             # 发送任务状态更新通知
-            asyncio.create_task(self._send_realtime_notification(
+            self._notify_queue.put_nowait((
                 task.user_id,
                 "task_status_update",
                 {
@@ -216,9 +263,11 @@ class TaskProcessor:
             type=notification_type
         )
         db.add(notification)
-        
+        # 先flush以获得自增主键，否则推送给前端的id为None
+        db.flush([notification])
+
         # 发送实时通知
-        asyncio.create_task(self._send_realtime_notification(
+        self._notify_queue.put_nowait((
             user_id, 
             "notification", 
             {
@@ -230,14 +279,16 @@ class TaskProcessor:
             }
         ))
     
-    async def _send_realtime_notification(self, user_id: int, notification_type: str, data: dict):
-        """发送实时通知"""
-        try:
-            # 动态导入以避免循环导入
-            from main import send_realtime_notification
-            await send_realtime_notification(user_id, notification_type, data)
-        except Exception as e:
-            logger.error(f"发送实时通知失败: {e}")
+    async def _notifier_loop(self):
+        """消费通知队列并逐条发送实时通知"""
+        while True:
+            user_id, notification_type, data = await self._notify_queue.get()
+            try:
+                await _get_send_realtime()(user_id, notification_type, data)
+            except Exception as e:
+                logger.error(f"发送实时通知失败: {e}")
+            finally:
+                self._notify_queue.task_done()
 
 # 创建全局任务处理器实例
 task_processor = TaskProcessor()
@@ -1,11 +1,45 @@
+from sqlalchemy import case, func, insert, literal_column, or_, update
 from sqlalchemy.orm import Session
-from models import Task, TaskStatus, TaskLog, User
-from typing import Dict, List, Optional
+from models import Task, TaskStatus, TaskLog, User, UserRole
+from typing import Dict, List, Optional, Tuple
 import logging
+import re
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# 操作完成标记的后缀，TaskLog.action_tag 形如 "generate_code:completed"
+_COMPLETED_SUFFIX = ':completed'
+
+# 操作失败标记，仍以 "action:xxx:failed" 形式写在日志消息中
+_FAILED_ACTION_RE = re.compile(r'action:([^:\s]+):failed')
+
+# 分支名称规范（例如：feature/task-{id}）
+_BRANCH_NAME_RE = re.compile(r'^(feature|bugfix|hotfix)/[a-zA-Z0-9_-]+$')
+
+# 基本的Python代码结构关键字，合并为一个模式只扫描一遍代码
+_CODE_STRUCTURE_RE = re.compile(r'def |class |import |from ')
+
+# 各验证方法依赖的日志消息关键字
+_LOG_MARKERS = ('tests_passed', 'coverage', 'push_successful', 'deployment_successful')
+
+# 步骤未配置editable_by时允许编辑的角色
+_DEFAULT_EDITABLE_BY = frozenset({UserRole.USER, UserRole.ADMIN})
+
+# 操作 -> Task上对应的完成标记列，步骤完成检查直接读取该列而无需查询日志
+_ACTION_FLAGS = {
+    'generate_code': 'generate_code_completed',
+    'submit_code': 'submit_code_completed',
+    'admin_review': 'admin_review_completed',
+    'deploy': 'deploy_completed'
+}
+
+# 允许标记完成的操作：带完成标记列的操作 + 前置条件校验中检查的操作
+_MARKABLE_ACTIONS = frozenset(_ACTION_FLAGS) | frozenset({'code_files_downloaded', 'tests_confirmed'})
+
+# TaskStatus -> 字符串值，状态流转时用普通字典查找代替枚举 .value 属性访问
+_STATUS_VALUE = {status: status.value for status in TaskStatus}
+
 class TaskWorkflowService:
     """任务工作流程控制服务"""
     
@@ -16,32 +50,32 @@ class TaskWorkflowService:
             'name': '任务提交',
             'description': '任务已提交到系统',
             'auto': True,  # 自动完成
-            'required_actions': [],
-            'editable_by': ['user', 'admin']  # 用户和管理员都可以编辑
+            'required_actions': (),
+            'editable_by': frozenset({UserRole.USER, UserRole.ADMIN})  # 用户和管理员都可以编辑
         },
         {
             'status': TaskStatus.TEST_READY,
             'name': '代码生成',
             'description': '代码生成步骤已完成，准备进入测试',
             'auto': False,  # 需要手动触发
-            'required_actions': ['generate_code'],
-            'editable_by': ['user', 'admin']  # 用户和管理员都可以编辑
+            'required_actions': ('generate_code',),
+            'editable_by': frozenset({UserRole.USER, UserRole.ADMIN})  # 用户和管理员都可以编辑
         },
         {
             'status': TaskStatus.CODE_SUBMITTED,
             'name': '代码提交',
             'description': '代码已提交，等待审核',
             'auto': False,
-            'required_actions': ['submit_code'],
-            'editable_by': ['user', 'admin']  # 用户和管理员都可以编辑
+            'required_actions': ('submit_code',),
+            'editable_by': frozenset({UserRole.USER, UserRole.ADMIN})  # 用户和管理员都可以编辑
         },
         {
             'status': TaskStatus.UNDER_REVIEW,
             'name': '管理员审核',
             'description': '管理员正在审核代码，可以选择通过或拒绝',
             'auto': False,  # 管理员手动操作
-            'required_actions': ['admin_review'],
-            'editable_by': ['admin'],  # 只有管理员可以编辑
+            'required_actions': ('admin_review',),
+            'editable_by': frozenset({UserRole.ADMIN}),  # 只有管理员可以编辑
             'allow_remarks': True  # 允许添加备注
         },
         {
@@ -49,13 +83,61 @@ class TaskWorkflowService:
             'name': '部署完成',
             'description': 'API已成功部署到生产环境',
             'auto': False,
-            'required_actions': ['deploy'],
-            'editable_by': ['admin']  # 只有管理员可以编辑
+            'required_actions': ('deploy',),
+            'editable_by': frozenset({UserRole.ADMIN})  # 只有管理员可以编辑
         }
     ]
     
+    # 状态 -> 步骤索引 / 步骤定义，类加载时构建一次，避免每次线性扫描
+    _STATUS_INDEX = {step['status']: i for i, step in enumerate(WORKFLOW_STEPS)}
+    _STATUS_STEP = {step['status']: step for step in WORKFLOW_STEPS}
+    _TOTAL_STEPS = len(WORKFLOW_STEPS)
+    _LAST_STEP_INDEX = _TOTAL_STEPS - 1
+    
+    # 步骤状态 -> Task上表示该步骤所需操作已完成的标记列
+    _STEP_COMPLETION_FLAG = {
+        step['status']: _ACTION_FLAGS[action]
+        for step in WORKFLOW_STEPS
+        for action in step['required_actions']
+    }
+    
+    # 各步骤的前置条件：(条件名, 描述, 检查函数(task, service) -> bool)
+    _PREREQS = {
+        TaskStatus.TEST_READY: (
+            # 如果到了这个状态，说明任务已提交
+            ('task_submitted', '任务需要先提交', lambda task, service: True),
+            ('requirements_clear', '需求描述应该清晰完整',
+             lambda task, service: bool(task.description and len(task.description.strip()) > 20)),
+        ),
+    }
+    
+    # 进度信息中各步骤的静态部分，渲染时浅拷贝后只补充与任务相关的字段
+    _STEP_TEMPLATES = tuple(
+        {
+            'index': i,
+            'status': step['status'].value,
+            'name': step['name'],
+            'description': step['description'],
+            'auto': step['auto'],
+            'required_actions': step['required_actions']
+        }
+        for i, step in enumerate(WORKFLOW_STEPS)
+    )
+    
     def __init__(self, db: Session):
         self.db = db
+        # 请求级缓存（服务实例随请求创建）：(任务ID, 状态, updated_at) -> 进度信息。
+        # 状态和updated_at也作为键的一部分：同一请求内任务被推进或回退后，即使未经过本服务清除缓存，
+        # 新状态也会落到新的键上，不会返回旧步骤的进度
+        self._progress_cache: Dict[Tuple[int, TaskStatus, Optional[datetime]], Dict] = {}
+        # 任务ID -> 操作状态（已完成操作、失败操作、日志关键字），见 _load_action_state
+        self._action_cache: Dict[int, Dict] = {}
+    
+    def _invalidate_task_cache(self, task_id: int):
+        """任务状态或操作记录变更后清除该任务的缓存"""
+        self._action_cache.pop(task_id, None)
+        for key in [key for key in self._progress_cache if key[0] == task_id]:
+            del self._progress_cache[key]
     
     def get_workflow_steps(self) -> List[Dict]:
         """获取工作流程步骤定义"""
@@ -63,15 +145,12 @@ class TaskWorkflowService:
     
     def get_current_step_index(self, task: Task) -> int:
         """获取当前步骤在工作流中的索引"""
-        for i, step in enumerate(self.WORKFLOW_STEPS):
-            if step['status'] == task.status:
-                return i
-        return 0
+        return self._STATUS_INDEX.get(task.status, 0)
     
     def get_next_step(self, task: Task) -> Optional[Dict]:
         """获取下一个步骤"""
         current_index = self.get_current_step_index(task)
-        if current_index < len(self.WORKFLOW_STEPS) - 1:
+        if current_index < self._LAST_STEP_INDEX:
             return self.WORKFLOW_STEPS[current_index + 1]
         return None
     
@@ -127,80 +206,71 @@ class TaskWorkflowService:
     
     def get_current_step(self, task: Task) -> Dict:
         """获取当前步骤信息"""
-        current_index = self.get_current_step_index(task)
-        return self.WORKFLOW_STEPS[current_index]
+        step = self._STATUS_STEP.get(task.status)
+        return step if step is not None else self.WORKFLOW_STEPS[0]
     
     def is_step_completed(self, task: Task, step: Dict) -> bool:
-        """检查步骤是否已完成"""
+        """检查步骤是否已完成（读取任务上的操作完成标记，不查询数据库）"""
         # 如果是自动步骤，认为已完成
         if step['auto']:
             return True
         
-        # 根据步骤类型检查完成条件
-        status = step['status']
-        
-        try:
-            if status == TaskStatus.SUBMITTED:
-                # 任务提交步骤，自动完成
-                return True
-            
-            elif status == TaskStatus.TEST_READY:
-                # 检查是否已完成代码生成步骤
-                return self.check_action_completed(task, 'generate_code')
-            
-            elif status == TaskStatus.CODE_SUBMITTED:
-                # 检查是否已提交代码
-                return self.check_action_completed(task, 'submit_code')
-            
-            elif status == TaskStatus.UNDER_REVIEW:
-                # 检查是否已完成管理员审核
-                return self.check_action_completed(task, 'admin_review')
-            
-            elif status == TaskStatus.DEPLOYED:
-                # 检查是否已部署
-                return self.check_action_completed(task, 'deploy')
-        
-        except Exception as e:
-            logger.error(f"检查步骤完成状态时发生错误: {str(e)}")
-            return False
-        
-        return False
+        # 检查该步骤所需操作在任务上的完成标记
+        flag = self._STEP_COMPLETION_FLAG.get(step['status'])
+        return bool(flag and getattr(task, flag))
     
     def check_action_completed(self, task: Task, action: str) -> bool:
         """检查特定操作是否已完成"""
         try:
-            # 查询任务日志中是否有相应的操作记录
-            log = self.db.query(TaskLog).filter(
-                TaskLog.task_id == task.id,
-                TaskLog.message.contains(f'action:{action}:completed')
-            ).first()
+            state = self._load_action_state(task)
             
-            if log:
-                logger.debug(f"任务 {task.id} 操作 {action} 已完成，时间: {log.created_at}")
+            if action in state['completed']:
+                logger.debug(f"任务 {task.id} 操作 {action} 已完成")
                 return True
             
             # 检查是否有失败记录
-            failed_log = self.db.query(TaskLog).filter(
-                TaskLog.task_id == task.id,
-                TaskLog.message.contains(f'action:{action}:failed')
-            ).first()
-            
-            if failed_log:
-                logger.warning(f"任务 {task.id} 操作 {action} 曾经失败: {failed_log.message}")
+            failed_message = state['failed'].get(action)
+            if failed_message:
+                logger.warning(f"任务 {task.id} 操作 {action} 曾经失败: {failed_message}")
             
             return False
         except Exception as e:
             logger.error(f"检查操作完成状态时发生错误: {str(e)}")
             return False
     
+    def _load_action_state(self, task: Task) -> Dict:
+        """一次查询加载任务的操作状态，供操作检查和各验证方法共用（请求内缓存）"""
+        state = self._action_cache.get(task.id)
+        if state is not None:
+            return state
+        
+        # 只读查询，无需先flush会话中的待提交修改
+        with self.db.no_autoflush:
+            rows = self.db.query(TaskLog.action_tag, TaskLog.message).filter(
+                TaskLog.task_id == task.id,
+                or_(
+                    TaskLog.action_tag.isnot(None),
+                    TaskLog.message.contains(':failed'),
+                    *(TaskLog.message.contains(marker) for marker in _LOG_MARKERS)
+                )
+            ).order_by(TaskLog.id).all()
+        
+        state = {'completed': set(), 'failed': {}, 'markers': set()}
+        for action_tag, message in rows:
+            if action_tag and action_tag.endswith(_COMPLETED_SUFFIX):
+                state['completed'].add(action_tag[:-len(_COMPLETED_SUFFIX)])
+            if message:
+                for action in _FAILED_ACTION_RE.findall(message):
+                    state['failed'][action] = message
+                state['markers'].update(marker for marker in _LOG_MARKERS if marker in message)
+        
+        self._action_cache[task.id] = state
+        return state
+    
     def has_permission_for_step(self, user: User, step: Dict) -> bool:
         """检查用户是否有权限执行某个步骤"""
-        # 获取步骤的权限配置
-        editable_by = step.get('editable_by', ['user', 'admin'])
-        
-        # 检查用户角色是否在允许的角色列表中
-        user_role = user.role.value
-        return user_role in editable_by
+        # 获取步骤的权限配置并检查用户角色是否在允许的角色集合中
+        return user.role in step.get('editable_by', _DEFAULT_EDITABLE_BY)
     
     def advance_to_next_step(self, task: Task, user: User, action_data: Dict = None) -> Dict[str, any]:
         """推进到下一步骤"""
@@ -214,33 +284,19 @@ class TaskWorkflowService:
             }
         
         next_step = check_result['next_step']
-        old_status = task.status
-        
-        # 更新任务状态
-        task.status = next_step['status']
-        task.updated_at = datetime.utcnow()
-        
-        # 记录状态变更日志
-        log_message = f"任务状态从 {old_status.value} 推进到 {next_step['status'].value}"
-        if action_data:
-            log_message += f"，操作数据: {action_data}"
-        
-        task_log = TaskLog(
-            task_id=task.id,
-            action_type="advance_step",
-            status=next_step['status'].value,
-            message=log_message
-        )
-        self.db.add(task_log)
         
         try:
+            # 状态更新与日志写入在同一事务中完成
+            self._write_advance({task.id: task.status}, next_step['status'], action_data)
             self.db.commit()
-            logger.info(f"任务 {task.id} 状态已更新为 {next_step['status'].value}")
+            self._invalidate_task_cache(task.id)
+            new_status_value = _STATUS_VALUE[next_step['status']]
+            logger.info(f"任务 {task.id} 状态已更新为 {new_status_value}")
             
             return {
                 'success': True,
                 'message': f"已推进到步骤: {next_step['name']}",
-                'new_status': next_step['status'].value,
+                'new_status': new_status_value,
                 'step_info': next_step
             }
         except Exception as e:
@@ -251,8 +307,39 @@ class TaskWorkflowService:
                 'message': f"状态更新失败: {str(e)}"
             }
     
+    def _write_advance(self, old_statuses: Dict[int, TaskStatus], new_status: TaskStatus, action_data: Dict = None):
+        """写入状态推进：一条UPDATE更新任务状态，一条INSERT记录日志（由调用方提交）"""
+        self.db.execute(
+            update(Task)
+            .where(Task.id.in_(list(old_statuses)))
+            .values(status=new_status, updated_at=func.now())
+        )
+        
+        # 记录状态变更日志
+        new_value = _STATUS_VALUE[new_status]
+        suffix = f"，操作数据: {action_data}" if action_data else ""
+        self.db.execute(insert(TaskLog), [
+            {
+                'task_id': task_id,
+                'action_type': "advance_step",
+                'status': new_value,
+                'message': f"任务状态从 {_STATUS_VALUE[old_status]} 推进到 {new_value}{suffix}"
+            }
+            for task_id, old_status in old_statuses.items()
+        ])
+    
+    @staticmethod
+    def is_markable_action(action: str) -> bool:
+        """检查操作是否允许标记为完成"""
+        return action in _MARKABLE_ACTIONS
+    
     def mark_action_completed(self, task: Task, action: str, message: str = None, user: User = None) -> bool:
         """标记某个操作为已完成"""
+        # action来自URL路径，只接受已知操作，避免写入超长或无法匹配的action_tag
+        if not self.is_markable_action(action):
+            logger.warning(f"任务 {task.id} 尝试标记未知操作: {action}")
+            return False
+        
         try:
             # 根据操作类型生成更友好的消息
             action_messages = {
@@ -267,18 +354,23 @@ class TaskWorkflowService:
             else:
                 log_message = action_messages.get(action, f"完成了 {action} 操作")
             
-            # 添加操作完成标记到消息中，用于后续检查
-            log_message_with_marker = f"{log_message} - action:{action}:completed"
+            # 操作完成标记写入独立的action_tag列，用于后续检查
+            flag = _ACTION_FLAGS.get(action)
+            if flag:
+                # 与日志在同一事务中置位任务上的完成标记
+                setattr(task, flag, True)
             
             task_log = TaskLog(
                 task_id=task.id,
                 user_id=user.id if user else None,
                 action_type=action,
-                status=task.status.value,
-                message=log_message_with_marker
+                status=_STATUS_VALUE[task.status],
+                message=log_message,
+                action_tag=f"{action}{_COMPLETED_SUFFIX}"
             )
             self.db.add(task_log)
             self.db.commit()
+            self._invalidate_task_cache(task.id)
             
             logger.info(f"任务 {task.id} 操作 {action} 已标记为完成")
             return True
@@ -289,51 +381,39 @@ class TaskWorkflowService:
     
     def get_task_progress_info(self, task: Task) -> Dict[str, any]:
         """获取任务的详细进度信息"""
+        cache_key = (task.id, task.status, task.updated_at)
+        cached = self._progress_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
         current_index = self.get_current_step_index(task)
         current_step = self.WORKFLOW_STEPS[current_index]
+        templates = self._STEP_TEMPLATES
+        is_completed = self.is_step_completed(task, current_step)
         
-        # 计算已完成的步骤
-        completed_steps = []
-        pending_steps = []
+        # 当前步骤之前的都已完成，之后的都待完成；已完成/待完成步骤为all_steps的前后两段切片
+        all_steps = [dict(tpl, completed=True, current=False) for tpl in templates[:current_index]]
+        all_steps.append(dict(
+            templates[current_index],
+            completed=is_completed,
+            current=True,
+            # 如果是最后一步（部署完成），不显示"进入下一步"按钮
+            can_advance=is_completed and current_step['status'] != TaskStatus.DEPLOYED
+        ))
+        all_steps.extend(dict(tpl, completed=False, current=False) for tpl in templates[current_index + 1:])
         
-        for i, step in enumerate(self.WORKFLOW_STEPS):
-            step_info = {
-                'index': i,
-                'status': step['status'].value,
-                'name': step['name'],
-                'description': step['description'],
-                'auto': step['auto'],
-                'required_actions': step['required_actions']
-            }
-            
-            if i < current_index:
-                step_info['completed'] = True
-                step_info['current'] = False
-                completed_steps.append(step_info)
-            elif i == current_index:
-                step_info['completed'] = self.is_step_completed(task, step)
-                step_info['current'] = True
-                # 如果是最后一步（部署完成），不显示"进入下一步"按钮
-                if step['status'] == TaskStatus.DEPLOYED:
-                    step_info['can_advance'] = False
-                else:
-                    step_info['can_advance'] = step_info['completed']
-                completed_steps.append(step_info)
-            else:
-                step_info['completed'] = False
-                step_info['current'] = False
-                pending_steps.append(step_info)
-        
-        return {
+        progress_info = {
             'current_step_index': current_index,
             'current_step': current_index,  # 返回步骤索引数字，而不是步骤对象
             'current_step_info': current_step,  # 步骤详细信息单独返回
-            'total_steps': len(self.WORKFLOW_STEPS),
-            'progress_percentage': int((current_index / (len(self.WORKFLOW_STEPS) - 1)) * 100),
-            'completed_steps': completed_steps,
-            'pending_steps': pending_steps,
-            'all_steps': completed_steps + pending_steps
+            'total_steps': self._TOTAL_STEPS,
+            'progress_percentage': current_index * 100 // self._LAST_STEP_INDEX,
+            'completed_steps': all_steps[:current_index + 1],
+            'pending_steps': all_steps[current_index + 1:],
+            'all_steps': all_steps
         }
+        self._progress_cache[cache_key] = progress_info
+        return progress_info
     
     def _validate_code_pull_completion(self, task: Task) -> bool:
         """验证代码拉取是否完成"""
@@ -349,47 +429,29 @@ class TaskWorkflowService:
     
     def _validate_branch_name(self, branch_name: str) -> bool:
         """验证分支名称格式"""
-        try:
-            # 检查分支名称是否符合规范（例如：feature/task-{id}）
-            import re
-            pattern = r'^(feature|bugfix|hotfix)/[a-zA-Z0-9_-]+$'
-            return bool(re.match(pattern, branch_name))
-        except Exception as e:
-            logger.error(f"验证分支名称失败: {str(e)}")
-            return True  # 如果验证失败，默认通过
+        # 检查分支名称是否符合规范（例如：feature/task-{id}）
+        return bool(branch_name) and _BRANCH_NAME_RE.match(branch_name) is not None
     
     def _validate_generated_code(self, task: Task) -> bool:
         """验证生成的代码质量"""
-        try:
-            if not task.generated_code:
-                return False
-            
-            # 基本的代码质量检查
-            code = task.generated_code.strip()
-            
-            # 检查代码长度（至少应该有一些实质内容）
-            if len(code) < 50:
-                return False
-            
-            # 检查是否包含基本的Python结构
-            basic_patterns = ['def ', 'class ', 'import ', 'from ']
-            has_basic_structure = any(pattern in code for pattern in basic_patterns)
-            
-            return has_basic_structure
-        except Exception as e:
-            logger.error(f"验证生成代码质量失败: {str(e)}")
-            return True  # 如果验证失败，默认通过
+        if not task.generated_code:
+            return False
+        
+        # 基本的代码质量检查
+        code = task.generated_code.strip()
+        
+        # 检查代码长度（至少应该有一些实质内容）
+        if len(code) < 50:
+            return False
+        
+        # 检查是否包含基本的Python结构
+        return _CODE_STRUCTURE_RE.search(code) is not None
     
     def _validate_test_results(self, task: Task) -> bool:
         """验证测试结果"""
         try:
             # 检查是否有测试通过的记录
-            test_passed_log = self.db.query(TaskLog).filter(
-                TaskLog.task_id == task.id,
-                TaskLog.message.contains('tests_passed')
-            ).first()
-            
-            return test_passed_log is not None
+            return 'tests_passed' in self._load_action_state(task)['markers']
         except Exception as e:
             logger.error(f"验证测试结果失败: {str(e)}")
             return False
@@ -398,12 +460,7 @@ class TaskWorkflowService:
         """验证测试覆盖率"""
         try:
             # 检查是否有测试覆盖率记录
-            coverage_log = self.db.query(TaskLog).filter(
-                TaskLog.task_id == task.id,
-                TaskLog.message.contains('coverage')
-            ).first()
-            
-            if coverage_log:
+            if 'coverage' in self._load_action_state(task)['markers']:
                 # 可以进一步解析覆盖率数据
                 return True
             
@@ -417,12 +474,7 @@ class TaskWorkflowService:
         """验证代码推送完成状态"""
         try:
             # 检查是否有推送成功的记录
-            push_success_log = self.db.query(TaskLog).filter(
-                TaskLog.task_id == task.id,
-                TaskLog.message.contains('push_successful')
-            ).first()
-            
-            return push_success_log is not None
+            return 'push_successful' in self._load_action_state(task)['markers']
         except Exception as e:
             logger.error(f"验证代码推送完成状态失败: {str(e)}")
             return False
@@ -431,12 +483,7 @@ class TaskWorkflowService:
         """验证部署状态"""
         try:
             # 检查是否有部署成功的记录
-            deploy_success_log = self.db.query(TaskLog).filter(
-                TaskLog.task_id == task.id,
-                TaskLog.message.contains('deployment_successful')
-            ).first()
-            
-            return deploy_success_log is not None
+            return 'deployment_successful' in self._load_action_state(task)['markers']
         except Exception as e:
             logger.error(f"验证部署状态失败: {str(e)}")
             return False
@@ -444,44 +491,10 @@ class TaskWorkflowService:
     def validate_step_prerequisites(self, task: Task, target_step: Dict) -> Dict[str, any]:
         """验证步骤前置条件"""
         try:
-            status = target_step['status']
-            prerequisites = []
-            
-            # 定义每个步骤的前置条件
-            if status == TaskStatus.BRANCH_CREATED:
-                prerequisites.append({
-                    'condition': 'code_pulled',
-                    'description': '需要先完成代码拉取',
-                    'met': self.check_action_completed(task, 'pull_code')
-                })
-            
-            elif status == TaskStatus.TEST_READY:
-                prerequisites.extend([
-                    {
-                        'condition': 'task_submitted',
-                        'description': '任务需要先提交',
-                        'met': True  # 如果到了这个状态，说明任务已提交
-                    },
-                    {
-                        'condition': 'requirements_clear',
-                        'description': '需求描述应该清晰完整',
-                        'met': task.description and len(task.description.strip()) > 20
-                    }
-                ])
-            
-            elif status == TaskStatus.TESTING:
-                prerequisites.append({
-                    'condition': 'code_generated',
-                    'description': '需要先完成代码生成',
-                    'met': task.generated_code is not None
-                })
-            
-            elif status == TaskStatus.CODE_PUSHED:
-                prerequisites.append({
-                    'condition': 'tests_passed',
-                    'description': '需要先通过所有测试',
-                    'met': self._validate_test_results(task)
-                })
+            prerequisites = [
+                {'condition': condition, 'description': description, 'met': check(task, self)}
+                for condition, description, check in self._PREREQS.get(target_step['status'], ())
+            ]
             
             # 检查所有前置条件是否满足
             unmet_prerequisites = [p for p in prerequisites if not p['met']]
@@ -512,7 +525,7 @@ class TaskWorkflowService:
                 }
             
             # 检查用户权限（只有管理员可以回滚）
-            if user.role.value != 'admin':
+            if user.role != UserRole.ADMIN:
                 return {
                     'success': False,
                     'message': '只有管理员可以执行回滚操作'
@@ -521,29 +534,35 @@ class TaskWorkflowService:
             previous_step = self.WORKFLOW_STEPS[current_index - 1]
             old_status = task.status
             
-            # 更新任务状态
-            task.status = previous_step['status']
-            task.updated_at = datetime.utcnow()
+            # 直接UPDATE任务状态，不经过ORM对Task对象的flush处理；提交后task过期并按需重新加载
+            self.db.execute(
+                update(Task)
+                .where(Task.id == task.id)
+                .values(status=previous_step['status'], updated_at=func.now()),
+                execution_options={'synchronize_session': False}
+            )
             
             # 记录回滚日志
             rollback_reason = reason or '管理员手动回滚'
-            log_message = f"任务状态从 {old_status.value} 回滚到 {previous_step['status'].value}，原因: {rollback_reason}"
+            previous_value = _STATUS_VALUE[previous_step['status']]
+            log_message = f"任务状态从 {_STATUS_VALUE[old_status]} 回滚到 {previous_value}，原因: {rollback_reason}"
             
             task_log = TaskLog(
                 task_id=task.id,
                 action_type="rollback_step",
-                status=previous_step['status'].value,
+                status=previous_value,
                 message=log_message
             )
             self.db.add(task_log)
             self.db.commit()
+            self._invalidate_task_cache(task.id)
             
             logger.info(f"任务 {task.id} 已回滚到步骤: {previous_step['name']}")
             
             return {
                 'success': True,
                 'message': f"已回滚到步骤: {previous_step['name']}",
-                'new_status': previous_step['status'].value,
+                'new_status': previous_value,
                 'step_info': previous_step
             }
         
@@ -558,37 +577,49 @@ class TaskWorkflowService:
     def batch_update_task_status(self, task_ids: List[int], target_status: TaskStatus, user: User) -> Dict[str, any]:
         """批量更新任务状态"""
         try:
-            if user.role.value != 'admin':
+            if user.role != UserRole.ADMIN:
                 return {
                     'success': False,
                     'message': '只有管理员可以执行批量状态更新'
                 }
             
-            updated_tasks = []
-            failed_tasks = []
-            
-            for task_id in task_ids:
-                task = self.db.query(Task).filter(Task.id == task_id).first()
-                if not task:
-                    failed_tasks.append({'task_id': task_id, 'reason': '任务不存在'})
-                    continue
-                
-                old_status = task.status
-                task.status = target_status
-                task.updated_at = datetime.utcnow()
-                
-                # 记录状态变更日志
-                log_message = f"管理员批量更新：任务状态从 {old_status.value} 更新为 {target_status.value}"
-                task_log = TaskLog(
-                    task_id=task.id,
-                    action_type="batch_update",
-                    status=target_status.value,
-                    message=log_message
+            # 一次查询取出所有任务的当前状态，不装载完整的Task对象
+            old_statuses = dict(
+                self.db.query(Task.id, Task.status).filter(Task.id.in_(task_ids)).all()
+            )
+            updated_tasks = [task_id for task_id in task_ids if task_id in old_statuses]
+            failed_tasks = [
+                {'task_id': task_id, 'reason': '任务不存在'}
+                for task_id in task_ids if task_id not in old_statuses
+            ]
+            
+            # 已处于目标状态的任务无需写入（仍计入更新成功的任务）
+            changed_tasks = [task_id for task_id in updated_tasks if old_statuses[task_id] != target_status]
+            
+            if changed_tasks:
+                # 一条UPDATE更新所有任务，会话中已加载的任务对象在提交后过期重新加载
+                self.db.execute(
+                    update(Task)
+                    .where(Task.id.in_(changed_tasks), Task.status != target_status)
+                    .values(status=target_status, updated_at=func.now()),
+                    execution_options={'synchronize_session': False}
                 )
-                self.db.add(task_log)
-                updated_tasks.append(task_id)
+                
+                # 记录状态变更日志（一条多行INSERT）
+                target_value = _STATUS_VALUE[target_status]
+                self.db.execute(insert(TaskLog), [
+                    {
+                        'task_id': task_id,
+                        'action_type': "batch_update",
+                        'status': target_value,
+                        'message': f"管理员批量更新：任务状态从 {_STATUS_VALUE[old_statuses[task_id]]} 更新为 {target_value}"
+                    }
+                    for task_id in changed_tasks
+                ])
             
             self.db.commit()
+            for task_id in changed_tasks:
+                self._invalidate_task_cache(task_id)
             
             return {
                 'success': True,
@@ -608,64 +639,24 @@ class TaskWorkflowService:
     def get_workflow_health_check(self, task: Task) -> Dict[str, any]:
         """获取工作流程健康检查报告"""
         try:
-            current_step = self.get_current_step(task)
-            health_issues = []
-            warnings = []
-            
-            # 检查任务是否卡在某个步骤太久
-            if task.updated_at:
-                time_since_update = datetime.utcnow() - task.updated_at
-                if time_since_update.total_seconds() > 86400:  # 超过24小时
-                    health_issues.append({
-                        'type': 'stuck_step',
-                        'message': f'任务在步骤 "{current_step["name"]}" 停留超过24小时',
-                        'severity': 'high'
-                    })
-                elif time_since_update.total_seconds() > 3600:  # 超过1小时
-                    warnings.append({
-                        'type': 'slow_progress',
-                        'message': f'任务在步骤 "{current_step["name"]}" 停留超过1小时',
-                        'severity': 'medium'
-                    })
-            
-            # 检查是否有失败的操作记录
-            failed_actions = self.db.query(TaskLog).filter(
-                TaskLog.task_id == task.id,
-                TaskLog.message.contains(':failed')
-            ).all()
-            
-            if failed_actions:
-                health_issues.append({
-                    'type': 'failed_actions',
-                    'message': f'发现 {len(failed_actions)} 个失败的操作记录',
-                    'severity': 'medium',
-                    'details': [log.message for log in failed_actions[-3:]]  # 最近3个失败记录
-                })
-            
-            # 检查步骤完成状态
-            step_completion_status = self.is_step_completed(task, current_step)
-            if not step_completion_status and not current_step['auto']:
-                warnings.append({
-                    'type': 'incomplete_step',
-                    'message': f'当前步骤 "{current_step["name"]}" 尚未完成',
-                    'severity': 'low'
-                })
-            
-            # 计算健康分数
-            health_score = 100
-            health_score -= len(health_issues) * 20
-            health_score -= len(warnings) * 5
-            health_score = max(0, health_score)
-            
-            return {
-                'health_score': health_score,
-                'status': 'healthy' if health_score >= 80 else 'warning' if health_score >= 60 else 'critical',
-                'current_step': current_step,
-                'health_issues': health_issues,
-                'warnings': warnings,
-                'last_update': task.updated_at.isoformat() if task.updated_at else None,
-                'total_logs': self.db.query(TaskLog).filter(TaskLog.task_id == task.id).count()
-            }
+            # 一次查询统计日志总数和失败的操作记录数
+            is_failed = TaskLog.message.contains(':failed')
+            total_logs, failed_count = self.db.query(
+                func.count(TaskLog.id),
+                func.sum(case((is_failed, 1), else_=0))
+            ).filter(TaskLog.task_id == task.id).one()
+            failed_count = int(failed_count or 0)
+            
+            recent_failed = []
+            if failed_count:
+                # 只在有失败记录时取最近3个失败记录
+                rows = self.db.query(TaskLog.message).filter(
+                    TaskLog.task_id == task.id,
+                    is_failed
+                ).order_by(TaskLog.id.desc()).limit(3).all()
+                recent_failed = [message for (message,) in reversed(rows)]
+            
+            return self._build_health_report(task, total_logs, failed_count, recent_failed)
         
         except Exception as e:
             logger.error(f"获取工作流程健康检查失败: {str(e)}")
@@ -675,42 +666,102 @@ class TaskWorkflowService:
                 'error': str(e)
             }
     
+    def _build_health_report(self, task: Task, total_logs: int, failed_count: int, recent_failed: List[str]) -> Dict[str, any]:
+        """根据任务和已统计的日志数据生成健康检查报告（不查询数据库）"""
+        current_step = self.get_current_step(task)
+        health_issues = []
+        warnings = []
+        
+        # 检查任务是否卡在某个步骤太久
+        if task.updated_at:
+            time_since_update = datetime.utcnow() - task.updated_at
+            if time_since_update.total_seconds() > 86400:  # 超过24小时
+                health_issues.append({
+                    'type': 'stuck_step',
+                    'message': f'任务在步骤 "{current_step["name"]}" 停留超过24小时',
+                    'severity': 'high'
+                })
+            elif time_since_update.total_seconds() > 3600:  # 超过1小时
+                warnings.append({
+                    'type': 'slow_progress',
+                    'message': f'任务在步骤 "{current_step["name"]}" 停留超过1小时',
+                    'severity': 'medium'
+                })
+        
+        # 检查是否有失败的操作记录
+        if failed_count:
+            health_issues.append({
+                'type': 'failed_actions',
+                'message': f'发现 {failed_count} 个失败的操作记录',
+                'severity': 'medium',
+                'details': recent_failed  # 最近3个失败记录
+            })
+        
+        # 检查步骤完成状态
+        step_completion_status = self.is_step_completed(task, current_step)
+        if not step_completion_status and not current_step['auto']:
+            warnings.append({
+                'type': 'incomplete_step',
+                'message': f'当前步骤 "{current_step["name"]}" 尚未完成',
+                'severity': 'low'
+            })
+        
+        # 计算健康分数
+        health_score = 100
+        health_score -= len(health_issues) * 20
+        health_score -= len(warnings) * 5
+        health_score = max(0, health_score)
+        
+        return {
+            'health_score': health_score,
+            'status': 'healthy' if health_score >= 80 else 'warning' if health_score >= 60 else 'critical',
+            'current_step': current_step,
+            'health_issues': health_issues,
+            'warnings': warnings,
+            'last_update': task.updated_at.isoformat() if task.updated_at else None,
+            'total_logs': total_logs
+        }
+    
     def get_step_execution_statistics(self, step_status: TaskStatus = None) -> Dict[str, any]:
         """获取步骤执行统计信息"""
         try:
-            # 基础查询
-            query = self.db.query(Task)
+            # 按状态分组，在数据库中完成计数和平均耗时（秒）的计算
+            query = self.db.query(
+                Task.status,
+                func.count(Task.id),
+                func.avg(func.timestampdiff(literal_column('SECOND'), Task.created_at, Task.updated_at))
+            )
             if step_status:
                 query = query.filter(Task.status == step_status)
             
-            tasks = query.all()
+            stats_by_status = {
+                status: (count, avg_seconds)
+                for status, count, avg_seconds in query.group_by(Task.status).all()
+            }
+            total_tasks = sum(count for count, _ in stats_by_status.values())
             
             # 统计各步骤的任务数量
             step_counts = {}
+            completion_times = {}
             for step in self.WORKFLOW_STEPS:
-                count = len([t for t in tasks if t.status == step['status']])
-                step_counts[step['status'].value] = {
+                status_value = _STATUS_VALUE[step['status']]
+                count, avg_seconds = stats_by_status.get(step['status'], (0, None))
+                step_counts[status_value] = {
                     'count': count,
                     'step_name': step['name'],
-                    'percentage': (count / len(tasks) * 100) if tasks else 0
+                    'percentage': (count / total_tasks * 100) if total_tasks else 0
                 }
-            
-            # 计算平均完成时间（基于日志记录）
-            completion_times = {}
-            for step in self.WORKFLOW_STEPS:
-                step_tasks = [t for t in tasks if t.status == step['status']]
-                if step_tasks:
-                    avg_time = sum([
-                        (t.updated_at - t.created_at).total_seconds() 
-                        for t in step_tasks if t.updated_at and t.created_at
-                    ]) / len(step_tasks)
-                    completion_times[step['status'].value] = {
+                
+                # 平均完成时间（创建到最后更新），只统计有任务的步骤
+                if count:
+                    avg_time = float(avg_seconds or 0)
+                    completion_times[status_value] = {
                         'average_seconds': avg_time,
                         'average_hours': avg_time / 3600
                     }
             
             return {
-                'total_tasks': len(tasks),
+                'total_tasks': total_tasks,
                 'step_distribution': step_counts,
                 'completion_times': completion_times,
                 'generated_at': datetime.utcnow().isoformat()
@@ -1,32 +1,104 @@
 import asyncio
+import codecs
+import heapq
 import os
 import subprocess
-import psutil
 import threading
 import time
-from typing import Dict, Optional, Callable
+from typing import Dict, List, Optional, Callable, Tuple
 from uuid import uuid4
 import logging
-import queue
 
 logger = logging.getLogger(__name__)
 
+_READ_SIZE = 65536  # 单次读取的最大字节数
+_COALESCE_DELAY = 0.005  # 连续输出的合并窗口（秒），窗口内的数据只回调一次
+
+
+class _PipeWriter:
+    """与StreamWriter接口一致的阻塞管道写入器，实际写入放到线程中执行"""
+    
+    def __init__(self, pipe):
+        self._pipe = pipe
+        self._pending = bytearray()
+    
+    def write(self, data: bytes):
+        self._pending += data
+    
+    async def drain(self):
+        data = bytes(self._pending)
+        self._pending.clear()
+        await asyncio.to_thread(self._write, data)
+    
+    def _write(self, data: bytes):
+        self._pipe.write(data)
+        self._pipe.flush()
+
+
+class _ThreadedProcess:
+    """事件循环不支持子进程时（如Windows下的SelectorEventLoop）使用的Popen+读取线程实现，
+    对外提供与asyncio.subprocess.Process相同的接口"""
+    
+    def __init__(self, args: List[str], **popen_kwargs):
+        self._popen = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            **popen_kwargs
+        )
+        self.pid = self._popen.pid
+        self.stdin = _PipeWriter(self._popen.stdin)
+        self.stdout = asyncio.StreamReader()
+        self._loop = asyncio.get_running_loop()
+        threading.Thread(target=self._pump_stdout, daemon=True).start()
+    
+    def _pump_stdout(self):
+        """在线程中读取进程输出，并转交给事件循环中的StreamReader"""
+        try:
+            while True:
+                chunk = self._popen.stdout.read1(_READ_SIZE)
+                if not chunk:
+                    break
+                self._loop.call_soon_threadsafe(self.stdout.feed_data, chunk)
+        except Exception as e:
+            logger.error(f"Terminal reader thread error: {e}")
+        finally:
+            try:
+                self._loop.call_soon_threadsafe(self.stdout.feed_eof)
+            except RuntimeError:
+                # 事件循环已关闭
+                pass
+    
+    @property
+    def returncode(self) -> Optional[int]:
+        return self._popen.poll()
+    
+    def terminate(self):
+        self._popen.terminate()
+    
+    def kill(self):
+        self._popen.kill()
+    
+    async def wait(self) -> int:
+        return await asyncio.to_thread(self._popen.wait)
+
+
 class TerminalSession:
-    """终端会话类，管理单个终端进程（Windows兼容版本）"""
+    """终端会话类，管理单个终端进程（基于asyncio子进程，Windows兼容版本）"""
     
     def __init__(self, session_id: str, user_id: int, shell: str = None):
         self.session_id = session_id
         self.user_id = user_id
         self.shell = shell or self._get_default_shell()
-        self.process: Optional[subprocess.Popen] = None
+        self.process: Optional[asyncio.subprocess.Process] = None
         self.created_at = time.time()
         self.last_activity = time.time()
         self.is_active = False
         self.output_callback: Optional[Callable] = None
-        self._read_thread: Optional[threading.Thread] = None
-        self._stop_reading = False
-        self._input_queue = queue.Queue()
-        self._write_thread: Optional[threading.Thread] = None
+        self.on_exit: Optional[Callable[[], None]] = None  # 进程输出结束（退出）时回调
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._read_task: Optional[asyncio.Task] = None
         
     def _get_default_shell(self) -> str:
         """获取默认shell"""
@@ -35,39 +107,43 @@ class TerminalSession:
         else:  # Unix-like
             return os.environ.get('SHELL', '/bin/bash')
     
-    def start(self, output_callback: Callable[[str], None]):
+    async def start(self, output_callback: Callable[[str], None]):
         """启动终端会话"""
         try:
+            # 重新启动前先停掉旧的读取协程和进程，避免遗留孤儿进程
+            await self._stop_previous()
+            
             self.output_callback = output_callback
             
             # 启动进程
             if os.name == 'nt':  # Windows
                 # Windows下使用PowerShell
-                self.process = subprocess.Popen(
-                    [self.shell, '-NoLogo', '-NoExit'],
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    bufsize=0,
-                    creationflags=subprocess.CREATE_NEW_PROCESS_GROUP
-                )
+                args = [self.shell, '-NoLogo', '-NoExit']
+                extra = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
             else:  # Unix-like
-                self.process = subprocess.Popen(
-                    [self.shell],
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    bufsize=0
+                args = [self.shell]
+                extra = {}
+            
+            try:
+                self.process = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.STDOUT,
+                    **extra
                 )
+            except NotImplementedError:
+                # 当前事件循环不支持子进程（如Windows下uvicorn reload模式使用的SelectorEventLoop），
+                # 退回Popen+读取线程的实现
+                logger.info(f"Event loop lacks subprocess support, terminal session {self.session_id} uses reader thread")
+                self.process = _ThreadedProcess(args, **extra)
             
             self.is_active = True
             self.last_activity = time.time()
             
-            # 启动读取和写入线程
-            self._start_reading_thread()
-            self._start_writing_thread()
+            # 由单个协程读取输出，进程退出（EOF）时自然结束
+            self._loop = asyncio.get_running_loop()
+            self._read_task = asyncio.create_task(self._read_loop())
             
             logger.info(f"Terminal session {self.session_id} started for user {self.user_id}")
             
@@ -75,115 +151,90 @@ class TerminalSession:
             logger.error(f"Failed to start terminal session {self.session_id}: {e}")
             raise
     
-    def _start_reading_thread(self):
-        """启动读取输出的线程"""
-        self._stop_reading = False
-        self._read_thread = threading.Thread(target=self._read_output, daemon=True)
-        self._read_thread.start()
-    
-    def _start_writing_thread(self):
-        """启动写入输入的线程"""
-        self._write_thread = threading.Thread(target=self._write_input, daemon=True)
-        self._write_thread.start()
+    async def _stop_previous(self):
+        """取消上一次启动遗留的读取协程，并杀死仍在运行的旧进程"""
+        if self._read_task is not None and not self._read_task.done():
+            self._read_task.cancel()
+            try:
+                await self._read_task
+            except asyncio.CancelledError:
+                pass
+        self._read_task = None
+        
+        if self.process is not None and self.process.returncode is None:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+            await self.process.wait()
     
-    def _read_output(self):
+    async def _read_loop(self):
         """读取进程输出"""
+        # 增量解码，避免多字节字符被切分在两次读取之间
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        stdout = self.process.stdout
+        eof = False
         try:
-            while not self._stop_reading and self.process and self.process.poll() is None:
-                try:
-                    # 读取输出
-                    if self.process.stdout:
-                        output = self.process.stdout.read(1024)
-                        if output:
-                            self.last_activity = time.time()
-                            if self.output_callback:
-                                self.output_callback(output)
-                except Exception as e:
-                    if not self._stop_reading:
-                        logger.error(f"Error reading from process: {e}")
+            while not eof:
+                chunk = await stdout.read(_READ_SIZE)
+                if not chunk:
                     break
-                    
-                time.sleep(0.01)  # 避免CPU占用过高
                 
+                # 批量输出时在合并窗口内继续读取，减少回调（WebSocket帧）次数
+                buffer = bytearray(chunk)
+                deadline = self._loop.time() + _COALESCE_DELAY
+                while len(buffer) < _READ_SIZE:
+                    remaining = deadline - self._loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        more = await asyncio.wait_for(stdout.read(_READ_SIZE - len(buffer)), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    if not more:
+                        eof = True
+                        break
+                    buffer += more
+                
+                self.last_activity = time.time()
+                output = decoder.decode(buffer)
+                if output and self.output_callback:
+                    result = self.output_callback(output)
+                    if asyncio.iscoroutine(result):
+                        await result
+                
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"Terminal reading thread error: {e}")
+            logger.error(f"Terminal reading task error: {e}")
         finally:
             self.is_active = False
+            if self.on_exit:
+                self.on_exit()
     
-    def _write_input(self):
-        """写入输入的线程"""
-        try:
-            while not self._stop_reading and self.process and self.process.poll() is None:
-                try:
-                    # 从队列获取输入
-                    data = self._input_queue.get(timeout=0.1)
-                    if data and self.process.stdin:
-                        self.process.stdin.write(data)
-                        self.process.stdin.flush()
-                        self.last_activity = time.time()
-                except queue.Empty:
-                    continue
-                except Exception as e:
-                    if not self._stop_reading:
-                        logger.error(f"Error writing to process: {e}")
-                    break
-        except Exception as e:
-            logger.error(f"Terminal writing thread error: {e}")
-    
-    def write(self, data: str):
+    async def write(self, data: str):
         """向终端写入数据"""
-        if self.pty_process and self.pty_process.isalive():
-            try:
-                self.pty_process.write(data.encode('utf-8'))
-                self.last_activity = time.time()
-            except Exception as e:
-                logger.error(f"Error writing to terminal: {e}")
-                raise
-        else:
+        if not self.is_alive():
             raise Exception("Terminal process is not active")
+        
+        try:
+            self.process.stdin.write(data.encode('utf-8'))
+            await self.process.stdin.drain()
+            self.last_activity = time.time()
+        except Exception as e:
+            logger.error(f"Error writing to terminal: {e}")
+            raise
     
     def resize(self, rows: int, cols: int):
-        """调整终端大小"""
-        if self.pty_process and self.pty_process.isalive():
-            try:
-                self.pty_process.setwinsize(rows, cols)
-            except Exception as e:
-                logger.error(f"Error resizing terminal: {e}")
+        """调整终端大小（管道模式下没有伪终端，忽略）"""
+        logger.debug(f"Terminal session {self.session_id} resize to {rows}x{cols} ignored (no pty)")
     
     def terminate(self):
-        """终止终端会话"""
+        """终止终端会话（可在任意线程调用，不阻塞）"""
         try:
-            self._stop_reading = True
-            
-            if self.pty_process and self.pty_process.isalive():
-                # 尝试优雅关闭
-                try:
-                    if os.name == 'nt':
-                        # Windows下终止进程
-                        self.pty_process.terminate()
-                    else:
-                        # Unix-like系统发送SIGTERM
-                        self.pty_process.kill(signal.SIGTERM)
-                    
-                    # 等待进程结束
-                    for _ in range(50):  # 最多等待5秒
-                        if not self.pty_process.isalive():
-                            break
-                        time.sleep(0.1)
-                    
-                    # 如果还没结束，强制杀死
-                    if self.pty_process.isalive():
-                        if os.name == 'nt':
-                            self.pty_process.kill()
-                        else:
-                            self.pty_process.kill(signal.SIGKILL)
-                            
-                except Exception as e:
-                    logger.error(f"Error terminating PTY process: {e}")
-            
-            # 等待读取线程结束
-            if self._read_thread and self._read_thread.is_alive():
-                self._read_thread.join(timeout=2)
+            if self.process and self.process.returncode is None and self._loop and not self._loop.is_closed():
+                # 在会话所属的事件循环中终止进程，读取协程收到EOF后自行结束
+                self._loop.call_soon_threadsafe(self._terminate_process)
             
             self.is_active = False
             logger.info(f"Terminal session {self.session_id} terminated")
@@ -191,9 +242,32 @@ class TerminalSession:
         except Exception as e:
             logger.error(f"Error during terminal termination: {e}")
     
+    def _terminate_process(self):
+        """尝试优雅关闭进程，5秒后仍未结束则强制杀死"""
+        process = self.process
+        if process.returncode is not None:
+            return
+        
+        try:
+            process.terminate()
+            # 绑定当前进程对象，避免会话重新启动后误杀新进程
+            self._loop.call_later(5, self._kill_process, process)
+        except ProcessLookupError:
+            pass
+        except Exception as e:
+            logger.error(f"Error terminating terminal process: {e}")
+    
+    def _kill_process(self, process: asyncio.subprocess.Process):
+        """强制杀死仍未退出的进程"""
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+    
     def is_alive(self) -> bool:
         """检查终端是否还活着"""
-        return self.pty_process and self.pty_process.isalive() and self.is_active
+        return self.process is not None and self.process.returncode is None and self.is_active
     
     def get_age(self) -> float:
         """获取会话年龄（秒）"""
@@ -212,22 +286,24 @@ class TerminalManager:
         self.user_sessions: Dict[int, set] = {}  # 用户ID -> 会话ID集合
         self.max_sessions = max_sessions
         self.session_timeout = session_timeout  # 会话超时时间（秒）
-        self._cleanup_thread = None
-        self._start_cleanup_thread()
-        
-    def _start_cleanup_thread(self):
-        """启动清理线程"""
-        def cleanup_loop():
-            while True:
-                try:
-                    self.cleanup_expired_sessions()
-                    time.sleep(60)  # 每分钟检查一次
-                except Exception as e:
-                    logger.error(f"Cleanup thread error: {e}")
-                    time.sleep(60)
-        
-        self._cleanup_thread = threading.Thread(target=cleanup_loop, daemon=True)
-        self._cleanup_thread.start()
+        self._cleanup_task: Optional[asyncio.Task] = None
+        # (过期时间点, 会话ID)小顶堆，清理时只弹出已到期的条目；条目可能过时，弹出时再按会话实际状态复核
+        self._expiry_heap: List[Tuple[float, str]] = []
+        self._exited_sessions: set = set()  # 进程已退出、等待清理的会话
+    
+    def start(self):
+        """在事件循环中启动定期清理任务（应用启动时调用）"""
+        if self._cleanup_task is None or self._cleanup_task.done():
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+    
+    async def _cleanup_loop(self):
+        """每分钟清理一次过期会话"""
+        while True:
+            try:
+                self.cleanup_expired_sessions()
+            except Exception as e:
+                logger.error(f"Cleanup task error: {e}")
+            await asyncio.sleep(60)
     
     def create_session(self, user_id: int, shell: str = None) -> str:
         """创建新的终端会话"""
@@ -250,6 +326,8 @@ class TerminalManager:
         session = TerminalSession(session_id, user_id, shell)
         
         self.sessions[session_id] = session
+        session.on_exit = lambda: self._on_session_exit(session_id)
+        heapq.heappush(self._expiry_heap, (self._session_deadline(session), session_id))
         
         # 更新用户会话映射
         if user_id not in self.user_sessions:
@@ -281,16 +359,41 @@ class TerminalManager:
             
             logger.info(f"Removed terminal session {session_id}")
     
+    def _session_deadline(self, session: TerminalSession) -> float:
+        """会话的过期时间点：空闲超时与最长存活时间取先到者"""
+        return min(
+            session.last_activity + self.session_timeout,
+            session.created_at + self.session_timeout * 2
+        )
+    
+    def _on_session_exit(self, session_id: str):
+        """会话进程退出，留待下次清理时移除"""
+        if session_id in self.sessions:
+            self._exited_sessions.add(session_id)
+    
     def cleanup_expired_sessions(self):
-        """清理过期的会话"""
-        expired_sessions = []
+        """清理过期的会话（已退出的会话 + 堆顶已到期的会话）"""
+        # 退出后又被重新启动的会话不清理
+        expired_sessions = {
+            session_id for session_id in self._exited_sessions
+            if session_id in self.sessions and not self.sessions[session_id].is_alive()
+        }
+        self._exited_sessions.clear()
         
-        for session_id, session in self.sessions.items():
-            # 检查会话是否过期或已死亡
-            if (not session.is_alive() or 
-                session.get_idle_time() > self.session_timeout or
-                session.get_age() > self.session_timeout * 2):
-                expired_sessions.append(session_id)
+        now = time.time()
+        heap = self._expiry_heap
+        while heap and heap[0][0] < now:
+            _, session_id = heapq.heappop(heap)
+            session = self.sessions.get(session_id)
+            if session is None:
+                continue  # 会话已被移除
+            
+            # 入堆后可能有过活动，按最新的活动时间复核
+            deadline = self._session_deadline(session)
+            if deadline < now:
+                expired_sessions.add(session_id)
+            else:
+                heapq.heappush(heap, (deadline, session_id))
         
         for session_id in expired_sessions:
             self.remove_session(session_id)
@@ -318,6 +421,10 @@ class TerminalManager:
         """关闭所有会话"""
         logger.info("Shutting down terminal manager...")
         
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            self._cleanup_task = None
+        
         # 终止所有会话
         for session_id in list(self.sessions.keys()):
             self.remove_session(session_id)
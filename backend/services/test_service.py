@@ -1,8 +1,9 @@
-import os
+import asyncio
+import io
 import docker
-import tempfile
-import shutil
-from typing import Optional, Tuple
+import string
+import tarfile
+from typing import Any, Optional, Tuple
 from sqlalchemy.orm import Session
 from models import Task, TaskLog, TaskStatus
 import logging
@@ -13,17 +14,94 @@ import requests
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# docker客户端（及其底层APIClient）全局共享，连接池大小
+_DOCKER_POOL_SIZE = 32
+
+# 测试镜像的公共基础镜像：依赖对所有任务都相同，只在首次部署时构建一次
+_BASE_IMAGE = "test-base:py39"
+_BASE_DOCKERFILE = """
+FROM python:3.9-slim
+
+WORKDIR /app
+
+RUN pip install --no-cache-dir fastapi==0.104.1 uvicorn==0.24.0 pydantic==2.5.0
+"""
+
+# 服务健康检查的探测间隔（秒）
+_PROBE_INITIAL_DELAY = 0.05
+_PROBE_MAX_DELAY = 2.0
+
+# 每个任务的镜像只在基础镜像上叠加main.py一层
+_TASK_DOCKERFILE = f"""
+FROM {_BASE_IMAGE}
+
+WORKDIR /app
+
+COPY main.py .
+
+EXPOSE 8000
+
+CMD ["python", "main.py"]
+""".encode("utf-8")
+
+# 测试服务main.py模板，模块加载时构建一次
+_MAIN_PY_TEMPLATE = string.Template("""
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+import uvicorn
+
+app = FastAPI(
+    title="测试API - 任务${task_id}",
+    description="${title}",
+    version="1.0.0"
+)
+
+# 配置CORS
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# 生成的代码
+${code}
+
+@app.get("/")
+async def root():
+    return {
+        "message": "测试API运行中",
+        "task_id": ${task_id},
+        "task_title": "${title}"
+    }
+
+@app.get("/health")
+async def health_check():
+    return {"status": "healthy"}
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=8000)
+""")
+
 class TestEnvironmentService:
     """测试环境部署服务"""
     
     def __init__(self):
         """初始化测试服务"""
         try:
-            self.docker_client = docker.from_env()
+            # 并发部署时多个线程同时调用docker，放大连接池避免连接被丢弃重建
+            self.docker_client = docker.from_env(max_pool_size=_DOCKER_POOL_SIZE)
             logger.info("Docker客户端初始化成功")
         except Exception as e:
             logger.error(f"Docker客户端初始化失败：{str(e)}")
             self.docker_client = None
+        
+        # 健康检查复用同一个HTTP会话，连接保持长连接
+        self._http = requests.Session()
+        
+        # 基础镜像确认存在后不再重复检查
+        self._base_image_ready = False
     
     async def deploy_to_test_environment(
         self, 
@@ -40,9 +118,8 @@ class TestEnvironmentService:
             Tuple[success, test_url, error_message]
         """
         try:
-            # 更新任务状态
-            task.status = TaskStatus.TESTING
-            self._add_task_log(task.id, TaskStatus.TESTING, "开始部署测试环境", db)
+            # 部署测试环境不改变任务所处的工作流步骤，日志沿用任务当前状态
+            self._add_task_log(task.id, task.status, "开始部署测试环境", db)
             db.commit()
             
             # 检查Docker是否可用
@@ -52,54 +129,55 @@ class TestEnvironmentService:
                 db.commit()
                 return False, None, error_msg
             
-            # 创建临时目录
-            temp_dir = tempfile.mkdtemp(prefix=f"task_{task.id}_")
+            # 准备测试代码（内存中的构建上下文）
+            build_context = self._prepare_test_code(task)
             
-            try:
-                # 准备测试代码
-                self._prepare_test_code(task, temp_dir)
-                
-                # 构建Docker镜像
-                image_name = f"test-task-{task.id}"
-                success = self._build_docker_image(temp_dir, image_name, task.id, db)
-                
-                if not success:
-                    return False, None, "Docker镜像构建失败"
-                
-                # 运行容器
-                container_port = 8000 + task.id  # 避免端口冲突
-                container = self._run_container(image_name, container_port, task.id, db)
-                
-                if not container:
-                    return False, None, "容器启动失败"
+            # 构建Docker镜像，同时清理可能存在的同名旧容器
+            # docker调用是阻塞的，放到线程中执行；线程内不访问数据库会话，日志在await之后写入
+            image_name = f"test-task-{task.id}"
+            self._add_task_log(task.id, task.status, "开始构建Docker镜像", db)
+            build_error, _ = await asyncio.gather(
+                asyncio.to_thread(self._build_docker_image, build_context, image_name, task.id),
+                asyncio.to_thread(self._remove_stale_container, task.id)
+            )
+            
+            if build_error:
+                self._add_task_log(task.id, task.status, build_error, db)
+                db.commit()
+                return False, None, "Docker镜像构建失败"
+            self._add_task_log(task.id, task.status, "Docker镜像构建完成", db)
+            
+            # 运行容器
+            self._add_task_log(task.id, task.status, "启动容器", db)
+            container, container_port, run_error = await asyncio.to_thread(self._run_container, image_name, task.id)
+            
+            if not container:
+                self._add_task_log(task.id, task.status, run_error, db)
+                db.commit()
+                return False, None, "容器启动失败"
+            self._add_task_log(task.id, task.status, f"容器启动成功，端口：{container_port}", db)
+            
+            # 等待服务启动
+            test_url = f"http://localhost:{container_port}"
+            if await self._wait_for_service(test_url, task, db):
+                task.test_url = test_url
                 
-                # 等待服务启动
-                test_url = f"http://localhost:{container_port}"
-                if self._wait_for_service(test_url, task.id, db):
-                    # 更新任务状态
-                    task.status = TaskStatus.TEST_COMPLETED
-                    task.test_url = test_url
-                    
-                    self._add_task_log(
-                        task.id, 
-                        TaskStatus.TEST_COMPLETED, 
-                        f"测试环境部署成功，访问地址：{test_url}", 
-                        db
-                    )
-                    db.commit()
-                    
-                    logger.info(f"任务 {task.id} 测试环境部署成功：{test_url}")
-                    return True, test_url, None
-                else:
-                    error_msg = "服务启动超时"
-                    self._add_task_log(task.id, task.status, error_msg, db)
-                    db.commit()
-                    return False, None, error_msg
-                    
-            finally:
-                # 清理临时目录
-                shutil.rmtree(temp_dir, ignore_errors=True)
+                self._add_task_log(
+                    task.id, 
+                    task.status, 
+                    f"测试环境部署成功，访问地址：{test_url}", 
+                    db
+                )
+                db.commit()
                 
+                logger.info(f"任务 {task.id} 测试环境部署成功：{test_url}")
+                return True, test_url, None
+            else:
+                error_msg = "服务启动超时"
+                self._add_task_log(task.id, task.status, error_msg, db)
+                db.commit()
+                return False, None, error_msg
+            
         except Exception as e:
             error_msg = f"测试环境部署异常：{str(e)}"
             logger.error(error_msg)
@@ -107,160 +185,126 @@ class TestEnvironmentService:
             db.commit()
             return False, None, error_msg
     
-    def _prepare_test_code(self, task: Task, temp_dir: str):
-        """准备测试代码"""
-        # 创建main.py文件
-        main_py_content = f"""
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
-
-app = FastAPI(
-    title="测试API - 任务{task.id}",
-    description="{task.title}",
-    version="1.0.0"
-)
-
-# 配置CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# 生成的代码
-{task.generated_code or '# 暂无生成代码'}
-
-@app.get("/")
-async def root():
-    return {{
-        "message": "测试API运行中",
-        "task_id": {task.id},
-        "task_title": "{task.title}"
-    }}
-
-@app.get("/health")
-async def health_check():
-    return {{"status": "healthy"}}
-
-if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
-"""
-        
-        with open(os.path.join(temp_dir, "main.py"), "w", encoding="utf-8") as f:
-            f.write(main_py_content)
-        
-        # 创建requirements.txt
-        requirements_content = """
-fastapi==0.104.1
-uvicorn==0.24.0
-pydantic==2.5.0
-"""
-        
-        with open(os.path.join(temp_dir, "requirements.txt"), "w") as f:
-            f.write(requirements_content)
-        
-        # 创建Dockerfile
-        dockerfile_content = """
-FROM python:3.9-slim
-
-WORKDIR /app
-
-COPY requirements.txt .
-RUN pip install --no-cache-dir -r requirements.txt
-
-COPY main.py .
-
-EXPOSE 8000
-
-CMD ["python", "main.py"]
-"""
+    def _prepare_test_code(self, task: Task) -> io.BytesIO:
+        """准备测试代码，打包为内存中的tar构建上下文"""
+        # 生成main.py（标题写入字符串字面量，需转义反斜杠和双引号）
+        title = task.title.replace('\\', '\\\\').replace('"', '\\"')
+        main_py_content = _MAIN_PY_TEMPLATE.substitute(
+            task_id=task.id,
+            title=title,
+            code=task.generated_code or '# 暂无生成代码'
+        )
         
-        with open(os.path.join(temp_dir, "Dockerfile"), "w") as f:
-            f.write(dockerfile_content)
+        build_context = io.BytesIO()
+        with tarfile.open(fileobj=build_context, mode="w") as tar:
+            for name, data in (("Dockerfile", _TASK_DOCKERFILE), ("main.py", main_py_content.encode("utf-8"))):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        build_context.seek(0)
+        return build_context
     
-    def _build_docker_image(self, temp_dir: str, image_name: str, task_id: int, db: Session) -> bool:
-        """构建Docker镜像"""
+    def _build_docker_image(self, build_context: io.BytesIO, image_name: str, task_id: int) -> Optional[str]:
+        """构建Docker镜像（在工作线程中执行，不访问数据库）
+        
+        Returns:
+            失败时返回错误信息，成功时返回None
+        """
         try:
-            self._add_task_log(task_id, TaskStatus.TESTING, "开始构建Docker镜像", db)
-            db.commit()
+            self._ensure_base_image()
             
             # 构建镜像
-            image, logs = self.docker_client.images.build(
-                path=temp_dir,
-                tag=image_name,
-                rm=True
-            )
-            
-            self._add_task_log(task_id, TaskStatus.TESTING, "Docker镜像构建完成", db)
-            db.commit()
+            self._build_image(fileobj=build_context, custom_context=True, tag=image_name)
             
             logger.info(f"任务 {task_id} Docker镜像构建成功：{image_name}")
-            return True
+            return None
             
         except Exception as e:
             error_msg = f"Docker镜像构建失败：{str(e)}"
             logger.error(error_msg)
-            self._add_task_log(task_id, TaskStatus.TESTING, error_msg, db)
-            db.commit()
-            return False
+            return error_msg
     
-    def _run_container(self, image_name: str, port: int, task_id: int, db: Session):
-        """运行Docker容器"""
+    def _ensure_base_image(self):
+        """确保基础镜像存在，不存在时构建"""
+        if self._base_image_ready:
+            return
         try:
-            self._add_task_log(task_id, TaskStatus.TESTING, f"启动容器，端口：{port}", db)
-            db.commit()
-            
-            # 停止可能存在的同名容器
-            container_name = f"test-task-{task_id}"
-            try:
-                existing_container = self.docker_client.containers.get(container_name)
-                existing_container.stop()
-                existing_container.remove()
-            except docker.errors.NotFound:
-                pass
-            
-            # 运行新容器
+            self.docker_client.images.get(_BASE_IMAGE)
+        except docker.errors.ImageNotFound:
+            logger.info(f"构建测试基础镜像：{_BASE_IMAGE}")
+            self._build_image(
+                fileobj=io.BytesIO(_BASE_DOCKERFILE.encode("utf-8")),
+                tag=_BASE_IMAGE
+            )
+        self._base_image_ready = True
+    
+    def _build_image(self, **build_kwargs):
+        """通过底层API构建镜像，逐条消费构建输出，只检查错误不保留日志"""
+        for chunk in self.docker_client.api.build(rm=True, decode=True, **build_kwargs):
+            if 'error' in chunk:
+                raise docker.errors.BuildError(chunk['error'], [chunk])
+    
+    def _remove_stale_container(self, task_id: int):
+        """停止并删除可能存在的同名容器"""
+        try:
+            existing_container = self.docker_client.containers.get(f"test-task-{task_id}")
+            existing_container.stop()
+            existing_container.remove()
+        except docker.errors.NotFound:
+            pass
+        except Exception as e:
+            logger.warning(f"清理任务 {task_id} 旧容器失败：{str(e)}")
+    
+    def _run_container(self, image_name: str, task_id: int) -> Tuple[Optional[Any], Optional[int], Optional[str]]:
+        """运行Docker容器（在工作线程中执行，不访问数据库）
+        
+        容器使用默认bridge网络，8000端口映射到由Docker分配的空闲宿主机端口，
+        不与后端服务或其他任务的端口冲突，也无法访问宿主机回环地址上的服务
+        
+        Returns:
+            Tuple[container, host_port, error_message]
+        """
+        try:
+            # 运行新容器（同名旧容器已由_remove_stale_container清理）
             container = self.docker_client.containers.run(
                 image_name,
-                name=container_name,
-                ports={'8000/tcp': port},
+                name=f"test-task-{task_id}",
+                ports={'8000/tcp': None},
                 detach=True,
                 remove=True
             )
             
-            self._add_task_log(task_id, TaskStatus.TESTING, "容器启动成功", db)
-            db.commit()
+            # 重新读取容器信息以获得分配的宿主机端口
+            container.reload()
+            host_port = int(container.ports['8000/tcp'][0]['HostPort'])
             
-            logger.info(f"任务 {task_id} 容器启动成功：{container.id}")
-            return container
+            logger.info(f"任务 {task_id} 容器启动成功：{container.id}，端口：{host_port}")
+            return container, host_port, None
             
         except Exception as e:
             error_msg = f"容器启动失败：{str(e)}"
             logger.error(error_msg)
-            self._add_task_log(task_id, TaskStatus.TESTING, error_msg, db)
-            db.commit()
-            return None
+            return None, None, error_msg
     
-    def _wait_for_service(self, test_url: str, task_id: int, db: Session, timeout: int = 60) -> bool:
-        """等待服务启动"""
-        self._add_task_log(task_id, TaskStatus.TESTING, "等待服务启动", db)
-        db.commit()
+    async def _wait_for_service(self, test_url: str, task: Task, db: Session, timeout: int = 60) -> bool:
+        """等待服务启动（探测请求在线程中执行，等待期间不阻塞事件循环）"""
+        self._add_task_log(task.id, task.status, "等待服务启动", db)
         
-        start_time = time.time()
-        while time.time() - start_time < timeout:
+        health_url = f"{test_url}/health"
+        delay = _PROBE_INITIAL_DELAY
+        start_time = time.monotonic()
+        while time.monotonic() - start_time < timeout:
             try:
-                response = requests.get(f"{test_url}/health", timeout=5)
+                response = await asyncio.to_thread(self._http.get, health_url, timeout=5)
                 if response.status_code == 200:
-                    self._add_task_log(task_id, TaskStatus.TESTING, "服务健康检查通过", db)
-                    db.commit()
+                    self._add_task_log(task.id, task.status, "服务健康检查通过", db)
                     return True
             except requests.RequestException:
                 pass
             
-            time.sleep(2)
+            # 退避间隔从50ms开始逐步拉长，服务很快就绪时能更早探测到
+            await asyncio.sleep(delay)
+            delay = min(delay * 1.5, _PROBE_MAX_DELAY)
         
         return False
     
@@ -291,7 +335,7 @@ CMD ["python", "main.py"]
             logger.error(f"清理测试环境失败：{str(e)}")
     
     def _add_task_log(self, task_id: int, status: TaskStatus, message: str, db: Session):
-        """添加任务日志"""
+        """添加任务日志（只加入会话，由deploy_to_test_environment在结束时统一提交）"""
         task_log = TaskLog(
             task_id=task_id,
             action_type="test_execution",
@@ -10,8 +10,8 @@ import json
 import logging
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple, Any
-from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import and_, insert, select
 
 from database import SessionLocal
 from models import (
@@ -24,186 +24,209 @@ from services.ai_service import ai_service
 
 logger = logging.getLogger(__name__)
 
+# 15步工作流程模板
+_WORKFLOW_TEMPLATE = [
+    {
+        "step_number": 1,
+        "step_type": WorkflowStepType.DEMAND_ANALYSIS,
+        "step_name": "需求分析",
+        "step_description": "分析用户需求，生成详细的API规格说明",
+        "requires_user_input": True,
+        "estimated_duration": 300,  # 5分钟
+        "actions": [
+            {"action_type": ActionType.USER_INPUT, "action_name": "收集需求信息"},
+            {"action_type": ActionType.AI_GENERATE, "action_name": "生成API规格"}
+        ]
+    },
+    {
+        "step_number": 2,
+        "step_type": WorkflowStepType.SERVER_CONNECTION,
+        "step_name": "服务器连接",
+        "step_description": "建立与目标服务器的SSH连接",
+        "requires_user_input": True,
+        "estimated_duration": 180,  # 3分钟
+        "actions": [
+            {"action_type": ActionType.USER_INPUT, "action_name": "输入服务器信息"},
+            {"action_type": ActionType.SYSTEM_AUTO, "action_name": "建立SSH连接"}
+        ]
+    },
+    {
+        "step_number": 3,
+        "step_type": WorkflowStepType.CODE_PULL,
+        "step_name": "代码拉取",
+        "step_description": "从Git仓库拉取最新代码",
+        "requires_user_input": False,
+        "estimated_duration": 120,  # 2分钟
+        "actions": [
+            {"action_type": ActionType.COMMAND_EXEC, "action_name": "Git拉取代码"}
+        ]
+    },
+    {
+        "step_number": 4,
+        "step_type": WorkflowStepType.BRANCH_CREATE,
+        "step_name": "分支创建",
+        "step_description": "创建新的开发分支",
+        "requires_user_input": False,
+        "estimated_duration": 60,  # 1分钟
+        "actions": [
+            {"action_type": ActionType.COMMAND_EXEC, "action_name": "创建Git分支"}
+        ]
+    },
+    {
+        "step_number": 5,
+        "step_type": WorkflowStepType.AI_CODE_GENERATION,
+        "step_name": "AI代码生成",
+        "step_description": "使用AI生成API代码",
+        "requires_user_input": False,
+        "estimated_duration": 600,  # 10分钟
+        "actions": [
+            {"action_type": ActionType.AI_GENERATE, "action_name": "生成API代码"},
+            {"action_type": ActionType.AI_GENERATE, "action_name": "生成测试代码"}
+        ]
+    },
+    {
+        "step_number": 6,
+        "step_type": WorkflowStepType.CODE_INTEGRATION,
+        "step_name": "代码集成",
+        "step_description": "将生成的代码集成到项目中",
+        "requires_user_input": False,
+        "estimated_duration": 300,  # 5分钟
+        "actions": [
+            {"action_type": ActionType.FILE_OPERATION, "action_name": "写入代码文件"},
+            {"action_type": ActionType.FILE_OPERATION, "action_name": "更新配置文件"}
+        ]
+    },
+    {
+        "step_number": 7,
+        "step_type": WorkflowStepType.SYNTAX_CHECK,
+        "step_name": "语法检查",
+        "step_description": "检查代码语法错误",
+        "requires_user_input": False,
+        "estimated_duration": 120,  # 2分钟
+        "actions": [
+            {"action_type": ActionType.COMMAND_EXEC, "action_name": "运行语法检查"}
+        ]
+    },
+    {
+        "step_number": 8,
+        "step_type": WorkflowStepType.UNIT_TEST,
+        "step_name": "单元测试",
+        "step_description": "运行单元测试",
+        "requires_user_input": False,
+        "estimated_duration": 300,  # 5分钟
+        "actions": [
+            {"action_type": ActionType.COMMAND_EXEC, "action_name": "运行单元测试"}
+        ]
+    },
+    {
+        "step_number": 9,
+        "step_type": WorkflowStepType.API_TEST,
+        "step_name": "API测试",
+        "step_description": "测试API接口功能",
+        "requires_user_input": False,
+        "estimated_duration": 240,  # 4分钟
+        "actions": [
+            {"action_type": ActionType.API_CALL, "action_name": "测试API端点"}
+        ]
+    },
+    {
+        "step_number": 10,
+        "step_type": WorkflowStepType.PERFORMANCE_TEST,
+        "step_name": "性能测试",
+        "step_description": "测试API性能指标",
+        "requires_user_input": False,
+        "estimated_duration": 360,  # 6分钟
+        "actions": [
+            {"action_type": ActionType.COMMAND_EXEC, "action_name": "运行性能测试"}
+        ]
+    },
+    {
+        "step_number": 11,
+        "step_type": WorkflowStepType.CODE_COMMIT,
+        "step_name": "代码提交",
+        "step_description": "提交代码到本地仓库",
+        "requires_user_input": False,
+        "estimated_duration": 60,  # 1分钟
+        "actions": [
+            {"action_type": ActionType.COMMAND_EXEC, "action_name": "Git提交代码"}
+        ]
+    },
+    {
+        "step_number": 12,
+        "step_type": WorkflowStepType.CODE_PUSH,
+        "step_name": "代码推送",
+        "step_description": "推送代码到远程仓库",
+        "requires_user_input": False,
+        "estimated_duration": 120,  # 2分钟
+        "actions": [
+            {"action_type": ActionType.COMMAND_EXEC, "action_name": "Git推送代码"}
+        ]
+    },
+    {
+        "step_number": 13,
+        "step_type": WorkflowStepType.DEPLOYMENT,
+        "step_name": "部署",
+        "step_description": "部署应用到生产环境",
+        "requires_user_input": False,
+        "estimated_duration": 480,  # 8分钟
+        "actions": [
+            {"action_type": ActionType.COMMAND_EXEC, "action_name": "部署应用"}
+        ]
+    },
+    {
+        "step_number": 14,
+        "step_type": WorkflowStepType.ADMIN_REVIEW,
+        "step_name": "管理员审核",
+        "step_description": "等待管理员审核和批准",
+        "requires_user_input": True,
+        "estimated_duration": 1800,  # 30分钟
+        "actions": [
+            {"action_type": ActionType.NOTIFICATION, "action_name": "通知管理员审核"},
+            {"action_type": ActionType.USER_INPUT, "action_name": "管理员审核决定"}
+        ]
+    },
+    {
+        "step_number": 15,
+        "step_type": WorkflowStepType.COMPLETION,
+        "step_name": "完成",
+        "step_description": "工作流程完成，生成报告",
+        "requires_user_input": False,
+        "estimated_duration": 60,  # 1分钟
+        "actions": [
+            {"action_type": ActionType.NOTIFICATION, "action_name": "发送完成通知"},
+            {"action_type": ActionType.SYSTEM_AUTO, "action_name": "生成完成报告"}
+        ]
+    }
+]
+
+# 建会话时插入的步骤行和操作行，模块加载时预先生成，插入时只补充session_id/step_id
+_STEP_ROWS = [
+    {
+        "step_number": step_template["step_number"],
+        "step_type": step_template["step_type"],
+        "step_name": step_template["step_name"],
+        "step_description": step_template["step_description"],
+        "requires_user_input": step_template["requires_user_input"],
+        "status": WorkflowStepStatus.PENDING if step_template["step_number"] == 1 else WorkflowStepStatus.BLOCKED
+    }
+    for step_template in _WORKFLOW_TEMPLATE
+]
+_ACTION_ROWS = [
+    (step_template["step_number"], {
+        "action_type": action_template["action_type"],
+        "action_name": action_template["action_name"],
+        "action_description": action_template.get("action_description", ""),
+        "status": WorkflowStepStatus.PENDING
+    })
+    for step_template in _WORKFLOW_TEMPLATE
+    for action_template in step_template["actions"]
+]
+
 class WorkflowEngine:
     """工作流程引擎 - 管理完整的15步开发流程"""
     
     def __init__(self):
         self.active_sessions: Dict[int, Dict] = {}  # session_id -> session_info
-        
-        # 定义15步工作流程模板
-        self.workflow_template = [
-            {
-                "step_number": 1,
-                "step_type": WorkflowStepType.DEMAND_ANALYSIS,
-                "step_name": "需求分析",
-                "step_description": "分析用户需求，生成详细的API规格说明",
-                "requires_user_input": True,
-                "estimated_duration": 300,  # 5分钟
-                "actions": [
-                    {"action_type": ActionType.USER_INPUT, "action_name": "收集需求信息"},
-                    {"action_type": ActionType.AI_GENERATE, "action_name": "生成API规格"}
-                ]
-            },
-            {
-                "step_number": 2,
-                "step_type": WorkflowStepType.SERVER_CONNECTION,
-                "step_name": "服务器连接",
-                "step_description": "建立与目标服务器的SSH连接",
-                "requires_user_input": True,
-                "estimated_duration": 180,  # 3分钟
-                "actions": [
-                    {"action_type": ActionType.USER_INPUT, "action_name": "输入服务器信息"},
-                    {"action_type": ActionType.SYSTEM_AUTO, "action_name": "建立SSH连接"}
-                ]
-            },
-            {
-                "step_number": 3,
-                "step_type": WorkflowStepType.CODE_PULL,
-                "step_name": "代码拉取",
-                "step_description": "从Git仓库拉取最新代码",
-                "requires_user_input": False,
-                "estimated_duration": 120,  # 2分钟
-                "actions": [
-                    {"action_type": ActionType.COMMAND_EXEC, "action_name": "Git拉取代码"}
-                ]
-            },
-            {
-                "step_number": 4,
-                "step_type": WorkflowStepType.BRANCH_CREATE,
-                "step_name": "分支创建",
-                "step_description": "创建新的开发分支",
-                "requires_user_input": False,
-                "estimated_duration": 60,  # 1分钟
-                "actions": [
-                    {"action_type": ActionType.COMMAND_EXEC, "action_name": "创建Git分支"}
-                ]
-            },
-            {
-                "step_number": 5,
-                "step_type": WorkflowStepType.AI_CODE_GENERATION,
-                "step_name": "AI代码生成",
-                "step_description": "使用AI生成API代码",
-                "requires_user_input": False,
-                "estimated_duration": 600,  # 10分钟
-                "actions": [
-                    {"action_type": ActionType.AI_GENERATE, "action_name": "生成API代码"},
-                    {"action_type": ActionType.AI_GENERATE, "action_name": "生成测试代码"}
-                ]
-            },
-            {
-                "step_number": 6,
-                "step_type": WorkflowStepType.CODE_INTEGRATION,
-                "step_name": "代码集成",
-                "step_description": "将生成的代码集成到项目中",
-                "requires_user_input": False,
-                "estimated_duration": 300,  # 5分钟
-                "actions": [
-                    {"action_type": ActionType.FILE_OPERATION, "action_name": "写入代码文件"},
-                    {"action_type": ActionType.FILE_OPERATION, "action_name": "更新配置文件"}
-                ]
-            },
-            {
-                "step_number": 7,
-                "step_type": WorkflowStepType.SYNTAX_CHECK,
-                "step_name": "语法检查",
-                "step_description": "检查代码语法错误",
-                "requires_user_input": False,
-                "estimated_duration": 120,  # 2分钟
-                "actions": [
-                    {"action_type": ActionType.COMMAND_EXEC, "action_name": "运行语法检查"}
-                ]
-            },
-            {
-                "step_number": 8,
-                "step_type": WorkflowStepType.UNIT_TEST,
-                "step_name": "单元测试",
-                "step_description": "运行单元测试",
-                "requires_user_input": False,
-                "estimated_duration": 300,  # 5分钟
-                "actions": [
-                    {"action_type": ActionType.COMMAND_EXEC, "action_name": "运行单元测试"}
-                ]
-            },
-            {
-                "step_number": 9,
-                "step_type": WorkflowStepType.API_TEST,
-                "step_name": "API测试",
-                "step_description": "测试API接口功能",
-                "requires_user_input": False,
-                "estimated_duration": 240,  # 4分钟
-                "actions": [
-                    {"action_type": ActionType.API_CALL, "action_name": "测试API端点"}
-                ]
-            },
-            {
-                "step_number": 10,
-                "step_type": WorkflowStepType.PERFORMANCE_TEST,
-                "step_name": "性能测试",
-                "step_description": "测试API性能指标",
-                "requires_user_input": False,
-                "estimated_duration": 360,  # 6分钟
-                "actions": [
-                    {"action_type": ActionType.COMMAND_EXEC, "action_name": "运行性能测试"}
-                ]
-            },
-            {
-                "step_number": 11,
-                "step_type": WorkflowStepType.CODE_COMMIT,
-                "step_name": "代码提交",
-                "step_description": "提交代码到本地仓库",
-                "requires_user_input": False,
-                "estimated_duration": 60,  # 1分钟
-                "actions": [
-                    {"action_type": ActionType.COMMAND_EXEC, "action_name": "Git提交代码"}
-                ]
-            },
-            {
-                "step_number": 12,
-                "step_type": WorkflowStepType.CODE_PUSH,
-                "step_name": "代码推送",
-                "step_description": "推送代码到远程仓库",
-                "requires_user_input": False,
-                "estimated_duration": 120,  # 2分钟
-                "actions": [
-                    {"action_type": ActionType.COMMAND_EXEC, "action_name": "Git推送代码"}
-                ]
-            },
-            {
-                "step_number": 13,
-                "step_type": WorkflowStepType.DEPLOYMENT,
-                "step_name": "部署",
-                "step_description": "部署应用到生产环境",
-                "requires_user_input": False,
-                "estimated_duration": 480,  # 8分钟
-                "actions": [
-                    {"action_type": ActionType.COMMAND_EXEC, "action_name": "部署应用"}
-                ]
-            },
-            {
-                "step_number": 14,
-                "step_type": WorkflowStepType.ADMIN_REVIEW,
-                "step_name": "管理员审核",
-                "step_description": "等待管理员审核和批准",
-                "requires_user_input": True,
-                "estimated_duration": 1800,  # 30分钟
-                "actions": [
-                    {"action_type": ActionType.NOTIFICATION, "action_name": "通知管理员审核"},
-                    {"action_type": ActionType.USER_INPUT, "action_name": "管理员审核决定"}
-                ]
-            },
-            {
-                "step_number": 15,
-                "step_type": WorkflowStepType.COMPLETION,
-                "step_name": "完成",
-                "step_description": "工作流程完成，生成报告",
-                "requires_user_input": False,
-                "estimated_duration": 60,  # 1分钟
-                "actions": [
-                    {"action_type": ActionType.NOTIFICATION, "action_name": "发送完成通知"},
-                    {"action_type": ActionType.SYSTEM_AUTO, "action_name": "生成完成报告"}
-                ]
-            }
-        ]
     
     async def create_workflow_session(
         self, 
@@ -244,11 +267,11 @@ class WorkflowEngine:
             )
             
             db.add(session)
-            db.commit()
-            db.refresh(session)
+            db.flush()  # 获取会话ID，会话与步骤在同一事务中提交
             
             # 创建工作流程步骤
             await self._create_workflow_steps(db, session.id)
+            db.commit()
             
             # 添加到活跃会话
             self.active_sessions[session.id] = {
@@ -269,34 +292,19 @@ class WorkflowEngine:
             db.close()
     
     async def _create_workflow_steps(self, db: Session, session_id: int):
-        """创建工作流程步骤"""
-        for step_template in self.workflow_template:
-            step = WorkflowStep(
-                session_id=session_id,
-                step_number=step_template["step_number"],
-                step_type=step_template["step_type"],
-                step_name=step_template["step_name"],
-                step_description=step_template["step_description"],
-                requires_user_input=step_template["requires_user_input"],
-                status=WorkflowStepStatus.PENDING if step_template["step_number"] == 1 else WorkflowStepStatus.BLOCKED
-            )
-            
-            db.add(step)
-            db.commit()
-            db.refresh(step)
-            
-            # 创建步骤操作
-            for action_template in step_template["actions"]:
-                action = StepAction(
-                    step_id=step.id,
-                    action_type=action_template["action_type"],
-                    action_name=action_template["action_name"],
-                    action_description=action_template.get("action_description", ""),
-                    status=WorkflowStepStatus.PENDING
-                )
-                db.add(action)
-            
-            db.commit()
+        """创建工作流程步骤（批量插入步骤和操作，由调用方提交）"""
+        db.execute(insert(WorkflowStep), [{**row, "session_id": session_id} for row in _STEP_ROWS])
+        
+        # MySQL不支持RETURNING，按步骤序号一次查回新步骤的ID
+        step_ids = dict(db.execute(
+            select(WorkflowStep.step_number, WorkflowStep.id)
+            .where(WorkflowStep.session_id == session_id)
+        ).all())
+        
+        # 创建步骤操作
+        db.execute(insert(StepAction), [
+            {**row, "step_id": step_ids[step_number]} for step_number, row in _ACTION_ROWS
+        ])
     
     async def get_workflow_status(
         self, 
@@ -310,20 +318,20 @@ class WorkflowEngine:
         """
         db = SessionLocal()
         try:
-            session = db.query(WorkflowSession).filter(
+            # 会话和步骤一次查询取回
+            session = db.query(WorkflowSession).options(
+                joinedload(WorkflowSession.steps)
+            ).filter(
                 WorkflowSession.id == session_id
             ).first()
             
             if not session:
                 return False, None, "工作流程会话不存在"
             
-            # 获取所有步骤
-            steps = db.query(WorkflowStep).filter(
-                WorkflowStep.session_id == session_id
-            ).order_by(WorkflowStep.step_number).all()
+            steps = sorted(session.steps, key=lambda s: s.step_number)
             
             # 计算进度
-            completed_steps = len([s for s in steps if s.status == WorkflowStepStatus.COMPLETED])
+            completed_steps = sum(1 for s in steps if s.status == WorkflowStepStatus.COMPLETED)
             progress_percentage = int((completed_steps / len(steps)) * 100)
             
             # 获取当前步骤
@@ -379,21 +387,21 @@ class WorkflowEngine:
             Tuple[success, error_message]
         """
         db = SessionLocal()
+        # 步骤执行期间以内存中的对象为准，中途提交后不必重新加载会话、步骤和操作
+        db.expire_on_commit = False
         try:
-            # 获取会话和步骤
-            session = db.query(WorkflowSession).filter(
+            # 会话和全部步骤一次查询取回（下一步骤也从中获取）
+            session = db.query(WorkflowSession).options(
+                joinedload(WorkflowSession.steps)
+            ).filter(
                 WorkflowSession.id == session_id
             ).first()
             
             if not session:
                 return False, "工作流程会话不存在"
             
-            step = db.query(WorkflowStep).filter(
-                and_(
-                    WorkflowStep.session_id == session_id,
-                    WorkflowStep.step_number == step_number
-                )
-            ).first()
+            steps_by_number = {s.step_number: s for s in session.steps}
+            step = steps_by_number.get(step_number)
             
             if not step:
                 return False, f"步骤 {step_number} 不存在"
@@ -410,7 +418,7 @@ class WorkflowEngine:
             db.commit()
             
             # 执行步骤操作
-            success = await self._execute_step_actions(db, step, user_input)
+            success = await self._execute_step_actions(db, session, step, user_input)
             
             if success:
                 step.status = WorkflowStepStatus.COMPLETED
@@ -423,12 +431,7 @@ class WorkflowEngine:
                 
                 # 激活下一步骤
                 if step_number < session.total_steps:
-                    next_step = db.query(WorkflowStep).filter(
-                        and_(
-                            WorkflowStep.session_id == session_id,
-                            WorkflowStep.step_number == step_number + 1
-                        )
-                    ).first()
+                    next_step = steps_by_number.get(step_number + 1)
                     
                     if next_step:
                         next_step.status = WorkflowStepStatus.PENDING
@@ -457,21 +460,17 @@ class WorkflowEngine:
     async def _execute_step_actions(
         self, 
         db: Session, 
+        session: WorkflowSession, 
         step: WorkflowStep, 
         user_input: Optional[Dict[str, Any]] = None
     ) -> bool:
-        """执行步骤中的所有操作"""
+        """执行步骤中的所有操作（只修改对象状态，由execute_step统一提交）"""
         try:
-            actions = db.query(StepAction).filter(
-                StepAction.step_id == step.id
-            ).all()
-            
-            for action in actions:
+            for action in step.actions:
                 action.status = WorkflowStepStatus.IN_PROGRESS
                 action.started_at = datetime.now()
-                db.commit()
                 
-                success = await self._execute_action(db, step, action, user_input)
+                success = await self._execute_action(db, session, step, action, user_input)
                 
                 if success:
                     action.status = WorkflowStepStatus.COMPLETED
@@ -480,10 +479,7 @@ class WorkflowEngine:
                 else:
                     action.status = WorkflowStepStatus.FAILED
                     step.error_message = action.error_message
-                    db.commit()
                     return False
-                
-                db.commit()
             
             return True
             
@@ -495,16 +491,13 @@ class WorkflowEngine:
     async def _execute_action(
         self, 
         db: Session, 
+        session: WorkflowSession, 
         step: WorkflowStep, 
         action: StepAction, 
         user_input: Optional[Dict[str, Any]] = None
     ) -> bool:
-        """执行单个操作"""
+        """执行单个操作（session由execute_step传入，不再重复查询）"""
         try:
-            session = db.query(WorkflowSession).filter(
-                WorkflowSession.id == step.session_id
-            ).first()
-            
             if action.action_type == ActionType.USER_INPUT:
                 # 用户输入操作
                 if user_input:
@@ -596,12 +589,10 @@ class WorkflowEngine:
                     self.active_sessions[session.id]['ssh_connection_id'] = connection_id
                 
                 action.output = f"SSH连接建立成功: {connection_id}"
-                db.commit()
                 return True
             else:
                 session.connection_status = DeploymentConnectionStatus.ERROR
                 action.error_message = error_msg
-                db.commit()
                 return False
                 
         except Exception as e:
@@ -639,7 +630,6 @@ class WorkflowEngine:
                 
                 session.api_specification = api_spec
                 action.output = json.dumps(api_spec, ensure_ascii=False, indent=2)
-                db.commit()
                 return True
             
             elif step.step_type == WorkflowStepType.AI_CODE_GENERATION:
@@ -671,9 +661,7 @@ class WorkflowEngine:
         """处理命令执行操作"""
         try:
             # 获取SSH连接
-            connection_id = None
-            if session.id in self.active_sessions:
-                connection_id = self.active_sessions[session.id].get('ssh_connection_id')
+            connection_id = self._get_ssh_connection_id(session.id)
             
             if not connection_id:
                 action.error_message = "没有可用的SSH连接"
@@ -707,6 +695,10 @@ class WorkflowEngine:
             action.error_message = f"命令执行失败: {str(e)}"
             return False
     
+    def _get_ssh_connection_id(self, session_id: int) -> Optional[str]:
+        """获取会话已建立的SSH连接ID"""
+        return self.active_sessions.get(session_id, {}).get('ssh_connection_id')
+    
     def _get_command_for_action(self, action_name: str, session: WorkflowSession) -> Optional[str]:
         """根据操作名称获取对应的命令"""
         command_map = {
@@ -731,9 +723,7 @@ class WorkflowEngine:
         """处理文件操作"""
         try:
             # 获取SSH连接
-            connection_id = None
-            if session.id in self.active_sessions:
-                connection_id = self.active_sessions[session.id].get('ssh_connection_id')
+            connection_id = self._get_ssh_connection_id(session.id)
             
             if not connection_id:
                 action.error_message = "没有可用的SSH连接"